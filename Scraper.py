@@ -7,7 +7,17 @@
     Created Date: 12/8/2016
 """
 
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import queue
+import sys
+import threading
+import traceback
+
+import ScraperCrawlState as CrawlState
 import ScraperDatabase as Database
+import ScraperMetrics as Metrics
+import ScraperTemplates.CommonScraper as CommonScraper
 
 """ADD NEW SCRAPERS HERE:"""
 from ScraperTemplates.TeasourceScraper import main as Teasource
@@ -16,39 +26,163 @@ SCRAPER_LIST = [
     Teasource,
     CamelliaSinensis
     ]
+
+BATCH_SIZE = 100    # products written to the database per transaction
+MAX_PENDING = 500   # max products parsed but not yet written.  Scrapers wait when the writer falls this far behind.
+RUN_REPORT_PATH = "scraper_run.json"    # timings and counters of the last run (see ScraperMetrics)
+CRAWL_STATE_PATH = "crawl_state.db"     # checkpoints of recent runs, for --resume (see ScraperCrawlState)
+PROMETHEUS_TEXTFILE_PATH = None         # also write them for node_exporter's textfile collector when set, ex.
+                                        #   "/var/lib/node_exporter/textfile_collector/teafinder_scraper.prom"
+
+# Placed on the product queue by each scraper thread when it finishes.
+_SCRAPER_DONE = object()
+
+
+def scraper_source(scraper):
+    """Source name of a scraper in SCRAPER_LIST, from its template's SOURCE."""
+    return getattr(sys.modules[scraper.__module__], "SOURCE", scraper.__module__)
+
+
+def stream_products(scrapers, max_pending=MAX_PENDING, failed=None):
+    """
+        Run each scraper (a function yielding Products) in its own thread and yield their products as they are parsed.
+        The queue between the scrapers and the caller is bounded, so memory stays constant however large the catalog.
+        An error raised by a scraper only ends that scraper.  With a failed dict it is stored there under the scraper and
+            the rest of the products are streamed as usual; otherwise it is re-raised once the other scrapers have
+            finished.
+    """
+    products = queue.Queue(maxsize=max_pending)
+    stop = threading.Event()
     
+    def run(scraper):
+        try:
+            for product in scraper():
+                if stop.is_set():
+                    break
+                products.put(product)
+        finally:
+            products.put(_SCRAPER_DONE)
+    
+    with ThreadPoolExecutor(max_workers=len(scrapers)) as executor:
+        futures = [executor.submit(run, scraper) for scraper in scrapers]
+        running = len(futures)
+        try:
+            while running:
+                product = products.get()
+                if product is _SCRAPER_DONE:
+                    running -= 1
+                else:
+                    yield product
+        finally:
+            # If the caller stopped early, let blocked scrapers finish instead of waiting on a full queue forever.
+            stop.set()
+            while running:
+                if products.get() is _SCRAPER_DONE:
+                    running -= 1
+        
+        for scraper, future in zip(scrapers, futures):
+            if failed is None:
+                future.result()
+            elif future.exception():
+                failed[scraper] = future.exception()
+
 
-def main():
+def batches(items, size):
+    """Group an iterable into lists of at most size items."""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+    
+
+def main(incremental=True, resume=False):
     """
         Load items from scrapers into the database.
-        For each product scraped, instantiate a ProductDB class to insert into the database.
+        Products stream from every scraper at once and are written in batches of BATCH_SIZE as they arrive (see
+            ScraperDatabase.bulk_upsert_products), so early results land while slower websites are still crawling.
+        In incremental mode only products that changed since the last run are rewritten; the rest are just marked as
+            seen.  incremental=False rewrites every product.
+        Timings and counters for the run are written to RUN_REPORT_PATH (and PROMETHEUS_TEXTFILE_PATH), even if the
+            run fails.
+        Each product page's progress is checkpointed in CRAWL_STATE_PATH.  If a run dies partway, resume=True continues
+            it: pages whose products were already written (or rejected) are skipped and only the rest are fetched.
+        A scraper that raises an error (ex. CommonScraper.ListingError) is recorded as failed in the checkpoints and the
+            run's metrics, and the rest of the run goes on.  Only its source is left out of deactivation.
     """
-    # Scrape each website
-    products = []
-    for scraper in SCRAPER_LIST:
-        products.extend(scraper())
-    
-    # Instantiate a ProductDB class for each product to insert into the database.
-    productdb = []
-    for product in products:
-        productdb.append(
-            Database.ProductDB(
-                tea_name=product.name, 
-                tea_type=product.type,
-                tea_description=product.description,
-                source_name=product.source,
-                product_id=product.id,
-                cost=product.cost, 
-                url=product.url,
-                image_url=product.image
-                )
-            )
+    metrics = Metrics.start_run()
+    saved = changed = total = 0
+    failed = {}
+    crawl = CrawlState.open_run(CRAWL_STATE_PATH, resume=resume)
+    print("{action} run {run}".format(action="Resuming" if crawl.resumed else "Starting", run=crawl.run_id))
+    CommonScraper.CRAWL = crawl
     
-    # Deactivate any products no longer available on websites
-    Database.deactivate_products()
+    try:
+        # Keep the small lookup tables in memory for the whole run.  The cache is cleared when the run ends.
+        with Database.lookup_cache():
+            # Scrape each website at the same time.  Page requests from every scraper share the CommonScraper fetch
+            # engine, which caps the number of requests in flight overall and per website.
+            # A scraper that fails doesn't stop the others.  Its source is recorded and left out of deactivation below.
+            for batch in batches(stream_products(SCRAPER_LIST, failed=failed), BATCH_SIZE):
+                with metrics.time_database("upsert", products=len(batch)):
+                    result = Database.bulk_upsert_products(batch, incremental=incremental)
+                metrics.count_written(saved=result.saved, changed=result.changed)
+                # Products skipped by the upsert stay "parsed", so a resumed run tries them again.
+                crawl.written(result.urls)
+                saved += result.saved
+                changed += result.changed
+                total += len(batch)
+            print("Saved {saved} of {total} products ({changed} changed)".format(
+                saved=saved, total=total, changed=changed))
+            
+            for scraper, error in failed.items():
+                if not isinstance(error, CommonScraper.ListingError):
+                    traceback.print_exception(type(error), error, error.__traceback__)
+                print("{source} scraper failed: {error}".format(source=scraper_source(scraper), error=error))
+                metrics.scraper_failed(scraper_source(scraper), error)
+                crawl.scraper_failed(scraper_source(scraper), error)
+            
+            # Deactivate any products no longer available on websites.  Products of a failed scraper's source were
+            # not all seen, so they are kept as they are until a run reads the whole website again.
+            with metrics.time_database("deactivate"):
+                deactivated = Database.deactivate_products(
+                    skip_sources=[scraper_source(scraper) for scraper in failed])
+            for source, count in deactivated.items():
+                metrics.count_written(deactivated=count)
+                print("Deactivated {count} products from {source}".format(count=count, source=source))
+            
+            # Only rebuild the web app's catalog and planner statistics if something changed.  The database keeps
+            # track (CatalogState), so changes from a run that died before getting this far, or made outside of the
+            # scraper, are picked up too.
+            if Database.catalog_dirty():
+                with metrics.time_database("catalog"):
+                    catalog_count = Database.rebuild_catalog()
+                print("Rebuilt catalog with {count} products".format(count=catalog_count))
+                with metrics.time_database("analyze"):
+                    Database.analyze_database()
+            
+            # Drop the web app's cached pages if they are older than the catalog.
+            Database.bump_catalog_version()
+        crawl.finish()
+    finally:
+        CommonScraper.CRAWL = None
+        print("Run {run} pages: {counts}".format(run=crawl.run_id, counts=crawl.counts()))
+        crawl.close()
+        metrics.finish()
+        if RUN_REPORT_PATH:
+            metrics.write_report(RUN_REPORT_PATH)
+        if PROMETHEUS_TEXTFILE_PATH:
+            metrics.write_prometheus(PROMETHEUS_TEXTFILE_PATH)
     
-    return productdb
+    return saved
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    arguments = argparse.ArgumentParser(description="Scrape the tea websites into teas.db.")
+    arguments.add_argument("--resume", action="store_true",
+                           help="continue the last run that didn't finish, skipping pages already written")
+    options = arguments.parse_args()
+    main(resume=options.resume)
\ No newline at end of file
@@ -0,0 +1,247 @@
+"""
+    ScraperBenchmark.py
+    Purpose: measure scraper speed offline, against the saved pages in ScraperFixtures.  No web requests are made.
+    Usage:
+        python ScraperBenchmark.py parse [--iterations N]
+            Compare the per-page parse cost of the parse backends (CommonScraper.PARSE_BACKEND) on the saved product
+            pages.  Both backends must read the same product from each page; the benchmark stops with an error if they
+            differ, so it should be run after changing a template's bs4 code or its PRODUCT_XPATH expressions.
+        python ScraperBenchmark.py crawl [--runs N] [--latency MS] [--backend soup|xpath] [--parse-workers N]
+            Run Scraper.main() end to end with every page served by CommonScraper.FixtureReplay, writing to a temporary
+            copy of teas.db (migrated first).  Reports pages/sec, parse ms/page, DB ms/product and peak memory, of the
+            process running the crawl and of its largest parse worker.  Each run is a fresh process, so the memory
+            figures are that run's own.  Later runs show the incremental crawl (nothing changed).  --latency adds a delay to every page to simulate network round trips.
+            --parse-workers sets CommonScraper.PARSE_WORKERS (0 parses in the scrapers' threads).
+            Measurements come from the run's ScraperMetrics.  Parse time is measured where the page is parsed (a parse
+            process, or a scraper thread), so it includes time spent waiting for the CPU.
+
+    Crawl results are appended to HISTORY_PATH and compared with the previous and the first (baseline) result for the
+        same settings, so the effect of a change can be checked against earlier commits.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows.  Peak memory is not reported there.
+    resource = None
+
+import Scraper
+import ScraperDatabase as Database
+import ScraperMetrics as Metrics
+import ScraperTemplates.CommonScraper as CommonScraper
+from ScraperTemplates.CommonScraper import make_page, SOUP_BACKEND, XPATH_BACKEND
+from ScraperTemplates import CamelliaSinensisScraper, TeasourceScraper
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURE_DIR = os.path.join(BASE_DIR, "ScraperFixtures")
+HISTORY_PATH = os.path.join(BASE_DIR, "benchmark_history.jsonl")
+ITERATIONS = 200
+
+# (template module, fixture file, product URL, extra parse_product arguments)
+FIXTURES = [
+    (CamelliaSinensisScraper, "camellia_sinensis_product.html",
+        "http://camellia-sinensis.com/en/long-jing-shi-feng-tv012", ()),
+    (TeasourceScraper, "teasource_product.html",
+        "https://www.teasource.com/collections/green-tea/products/clouds-and-mist-supreme-green-tea", ("Green Tea",)),
+    ]
+
+
+def parse_fixture(template, html, url, args, backend):
+    """Parse one page with the given backend, the same way the template's get_products does."""
+    if backend == XPATH_BACKEND:
+        return template.parse_product_tree(url, make_page(html, XPATH_BACKEND), *args)
+    return template.parse_product(url, make_page(html, template.PARSER), *args)
+
+
+def time_backend(template, html, url, args, backend, iterations):
+    """Return the mean milliseconds per page."""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        parse_fixture(template, html, url, args, backend)
+    return (time.perf_counter() - start) * 1000 / iterations
+
+
+def benchmark_parse(iterations=ITERATIONS):
+    print("{fixture:<36}{soup:>12}{xpath:>12}{speedup:>10}".format(
+        fixture="Fixture (ms per page)", soup=SOUP_BACKEND, xpath=XPATH_BACKEND, speedup="speedup"))
+
+    for template, filename, url, args in FIXTURES:
+        with open(os.path.join(FIXTURE_DIR, filename), "rb") as fixture:
+            html = fixture.read()
+
+        # Both backends must find the same product before their timings mean anything.
+        products = [parse_fixture(template, html, url, args, backend) for backend in (SOUP_BACKEND, XPATH_BACKEND)]
+        fields = [vars(product) if product else None for product in products]
+        if not fields[0] or fields[0] != fields[1]:
+            sys.exit("{filename}: backends disagree\n  {soup}: {soup_fields}\n  {xpath}: {xpath_fields}".format(
+                filename=filename, soup=SOUP_BACKEND, xpath=XPATH_BACKEND, soup_fields=fields[0], xpath_fields=fields[1]))
+
+        soup_ms = time_backend(template, html, url, args, SOUP_BACKEND, iterations)
+        xpath_ms = time_backend(template, html, url, args, XPATH_BACKEND, iterations)
+        print("{fixture:<36}{soup:>12.3f}{xpath:>12.3f}{speedup:>9.1f}x".format(
+            fixture=filename, soup=soup_ms, xpath=xpath_ms, speedup=soup_ms / xpath_ms))
+
+
+@contextlib.contextmanager
+def patched(module, name, value):
+    """Replace module.name with value for the length of the block."""
+    original = getattr(module, name)
+    setattr(module, name, value)
+    try:
+        yield original
+    finally:
+        setattr(module, name, original)
+
+
+def crawl_once(latency):
+    """Run Scraper.main() once against the fixtures.  Returns the measurements, read from the run's ScraperMetrics."""
+    replay = CommonScraper.FixtureReplay(FIXTURE_DIR, latency=latency / 1000)
+    with patched(CommonScraper, "REPLAY", replay), contextlib.redirect_stdout(io.StringIO()):
+        # The scrapers print every product.  Output is discarded to keep the report readable.
+        start = time.perf_counter()
+        Scraper.main()
+        seconds = time.perf_counter() - start
+
+    # Stop the parse workers so their memory shows in RUSAGE_CHILDREN, which only counts processes that have exited.
+    # Runs without a parse pool have no parse workers to report.
+    parse_workers = CommonScraper.parse_worker_count()
+    CommonScraper.shutdown_parse_pool()
+
+    usage = resource.getrusage(resource.RUSAGE_SELF) if resource else None
+    child_usage = resource.getrusage(resource.RUSAGE_CHILDREN) if resource and parse_workers else None
+    report = Metrics.METRICS.report()
+    parse_seconds = sum(histogram["sum_seconds"] for stage in ("parse", "extract") for histogram in report[stage].values())
+    upsert = report["database"].get("upsert", {"seconds": 0.0})
+    saved = report["written"].get("saved", 0)
+    return {
+        "seconds": round(seconds, 3),
+        "pages": replay.requests,
+        "products": saved,
+        "pages_per_sec": round(replay.requests / seconds, 1),
+        "parse_ms_per_page": round(parse_seconds * 1000 / max(replay.requests, 1), 3),
+        "db_ms_per_product": round(upsert["seconds"] * 1000 / max(saved, 1), 4),
+        "peak_rss_mb": round(usage.ru_maxrss / 1024, 1) if usage else None,
+        "peak_child_rss_mb": round(child_usage.ru_maxrss / 1024, 1) if child_usage else None
+        }
+
+
+def crawl_run(work_dir, latency, backend, parse_workers):
+    """One benchmark crawl, run in its own process by benchmark_crawl(), writing to the files in work_dir."""
+    with patched(Database, "DB_PATH", os.path.join(work_dir, "teas.db")), \
+            patched(Database, "CATALOG_VERSION_PATH", os.path.join(work_dir, "catalog.version")), \
+            patched(Scraper, "RUN_REPORT_PATH", os.path.join(work_dir, "scraper_run.json")), \
+            patched(Scraper, "CRAWL_STATE_PATH", os.path.join(work_dir, "crawl_state.db")), \
+            patched(Scraper, "PROMETHEUS_TEXTFILE_PATH", None), \
+            patched(CommonScraper, "PARSE_BACKEND", backend), \
+            patched(CommonScraper, "PARSE_WORKERS", parse_workers):
+        return crawl_once(latency)
+
+
+def git_commit():
+    """Short hash of the checked out commit, or None outside of git."""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def read_history(settings):
+    """Earlier results with the same settings, oldest first."""
+    if not os.path.exists(HISTORY_PATH):
+        return []
+    with open(HISTORY_PATH) as history:
+        entries = [json.loads(line) for line in history if line.strip()]
+    return [entry for entry in entries if entry["settings"] == settings]
+
+
+def compare(label, result, earlier):
+    """Print the change from an earlier result."""
+    changes = []
+    for key in ("pages_per_sec", "parse_ms_per_page", "db_ms_per_product", "peak_rss_mb", "peak_child_rss_mb"):
+        if result.get(key) and earlier.get(key):
+            changes.append("{key} {change:+.1f}%".format(key=key, change=(result[key] / earlier[key] - 1) * 100))
+    print("    vs {label} ({commit}, {date}): {changes}".format(
+        label=label, commit=earlier.get("commit"), date=earlier.get("date"), changes=", ".join(changes)))
+
+
+def migrate_copy(db_path):
+    """Bring a copy of teas.db up to date with the web app's migrations, which the scraper's queries rely on."""
+    try:
+        subprocess.run([sys.executable, os.path.join(BASE_DIR, "manage.py"), "migrate", "--verbosity", "0"],
+                       cwd=BASE_DIR, env=dict(os.environ, TEAFINDER_DB=db_path), check=True,
+                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError as error:
+        sys.exit("Could not migrate the benchmark's copy of teas.db.  Run python manage.py migrate first.\n"
+                 + error.stdout.decode(errors="replace"))
+
+
+def benchmark_crawl(runs=2, latency=0.0, backend=SOUP_BACKEND, parse_workers=None):
+    if parse_workers is None:
+        parse_workers = CommonScraper.parse_worker_count()
+    settings = {"mode": "crawl", "latency_ms": latency, "backend": backend, "parse_workers": parse_workers}
+
+    # Work on a copy of the database so the benchmark never touches the real catalog.
+    work_dir = tempfile.mkdtemp(prefix="teafinder-benchmark-")
+    try:
+        shutil.copy(Database.DB_PATH, os.path.join(work_dir, "teas.db"))
+        migrate_copy(os.path.join(work_dir, "teas.db"))
+        # Peak memory (ru_maxrss) never goes down within a process, so each run gets a fresh one.  Otherwise later runs
+        # would repeat the highest figure so far rather than report their own.
+        results = []
+        for _ in range(runs):
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as process:
+                results.append(process.submit(crawl_run, work_dir, latency, backend, parse_workers).result())
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    history = read_history(settings)
+    date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    commit = git_commit()
+    with open(HISTORY_PATH, "a") as history_file:
+        for run, result in enumerate(results, 1):
+            print("Run {run}: {pages} pages in {seconds}s ({pages_per_sec} pages/sec), parse {parse_ms_per_page} ms/page, "
+                  "db {db_ms_per_product} ms/product, {products} products, peak RSS {peak_rss_mb} MB{workers}".format(
+                    run=run, workers=" (parse worker {0} MB)".format(result["peak_child_rss_mb"])
+                    if result["peak_child_rss_mb"] is not None else "", **result))
+            earlier = [entry for entry in history if entry["run"] == run]
+            if earlier:
+                compare("previous", result, earlier[-1])
+                compare("baseline", result, earlier[0])
+            history_file.write(json.dumps(dict(result, run=run, date=date, commit=commit, settings=settings)) + "\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the scrapers against saved pages.")
+    commands = parser.add_subparsers(dest="command")
+    parse_command = commands.add_parser("parse", help="compare parse backends on saved product pages")
+    parse_command.add_argument("--iterations", type=int, default=ITERATIONS)
+    crawl_command = commands.add_parser("crawl", help="run Scraper.main() end to end against saved pages")
+    crawl_command.add_argument("--runs", type=int, default=2)
+    crawl_command.add_argument("--latency", type=float, default=0.0, help="milliseconds added to every page")
+    crawl_command.add_argument("--backend", choices=[SOUP_BACKEND, XPATH_BACKEND], default=SOUP_BACKEND)
+    crawl_command.add_argument("--parse-workers", type=int, default=None, help="parse processes (default: PARSE_WORKERS)")
+    args = parser.parse_args(argv)
+
+    if args.command == "crawl":
+        benchmark_crawl(runs=args.runs, latency=args.latency, backend=args.backend, parse_workers=args.parse_workers)
+    else:
+        benchmark_parse(getattr(args, "iterations", ITERATIONS))
+
+
+if __name__ == '__main__':
+    main()
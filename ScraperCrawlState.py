@@ -0,0 +1,181 @@
+"""
+    ScraperCrawlState.py
+    Purpose: checkpoints for scraper runs, so a run that dies partway can be resumed (Scraper.py --resume).
+
+    Each run is a row in Runs, and every product page it handles is a row in Pages with its status:
+        discovered  found on a listing page, not yet downloaded
+        fetched     downloaded, not yet parsed
+        parsed      a product was read from the page, not yet written to teas.db
+        rejected    the page had no usable product (see the run's ScraperMetrics for the reason)
+        written     the product is saved in teas.db
+        failed      the page could not be downloaded or raised an error while parsing (see Error)
+    A resumed run skips pages that are written or rejected and does everything else again.  Listing pages are always
+        read again, since that is how the remaining product URLs are found.
+    Scrapers that ended with an error are recorded per source in Failures.
+    The state is kept in its own sqlite file next to teas.db, so checkpoints never wait on the catalog's writes.
+    Status updates come from the CommonScraper fetch engine's threads, so they go through one locked connection.
+"""
+
+import datetime
+import sqlite3
+import threading
+
+KEEP_RUNS = 10      # runs kept in the state file.  Older runs and their pages are removed when a new run starts.
+
+RUNNING = "running"
+FINISHED = "finished"
+
+DISCOVERED = "discovered"
+FETCHED = "fetched"
+PARSED = "parsed"
+REJECTED = "rejected"
+WRITTEN = "written"
+FAILED = "failed"
+
+# Pages a resumed run does not need to handle again.
+DONE_STATUSES = (WRITTEN, REJECTED)
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS Runs (
+        ID INTEGER PRIMARY KEY AUTOINCREMENT,
+        StartedDate TEXT NOT NULL,
+        FinishedDate TEXT,
+        Status TEXT NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS Pages (
+        RunID INTEGER NOT NULL REFERENCES Runs (ID),
+        URL TEXT NOT NULL,
+        Status TEXT NOT NULL,
+        Error TEXT,
+        UpdatedDate TEXT NOT NULL,
+        PRIMARY KEY (RunID, URL)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS Failures (
+        RunID INTEGER NOT NULL REFERENCES Runs (ID),
+        Source TEXT NOT NULL,
+        Error TEXT NOT NULL,
+        UpdatedDate TEXT NOT NULL,
+        PRIMARY KEY (RunID, Source)
+    )
+    """
+]
+
+
+def now():
+    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+class CrawlRun:
+    """Checkpoints of one scraper run.  Use open_run() to start or resume one."""
+    def __init__(self, connection, run_id, resumed=False):
+        self.connection = connection
+        self.run_id = run_id
+        self.resumed = resumed
+        self._lock = threading.Lock()
+        self._done = {row[0] for row in connection.execute(
+            "SELECT URL FROM Pages WHERE RunID = ? AND Status IN ({params})".format(
+                params=", ".join("?" * len(DONE_STATUSES))),
+            (run_id,) + DONE_STATUSES)}
+
+    def _execute(self, sql, parameters):
+        with self._lock:
+            self.connection.execute(sql, parameters)
+
+    def set_status(self, url, status, error=None):
+        self._execute("""
+            INSERT INTO Pages (RunID, URL, Status, Error, UpdatedDate) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (RunID, URL) DO UPDATE SET
+                Status = excluded.Status,
+                Error = excluded.Error,
+                UpdatedDate = excluded.UpdatedDate
+            """, (self.run_id, url, status, error, now()))
+
+    def pending(self, urls):
+        """
+            Yield the product URLs that still need handling, recording each as discovered.  Pages already written or
+                rejected by an earlier attempt at this run are skipped.
+        """
+        for url in urls:
+            if url in self._done:
+                continue
+            self.set_status(url, DISCOVERED)
+            yield url
+
+    def fetched(self, url):
+        self.set_status(url, FETCHED)
+
+    def parsed(self, url):
+        self.set_status(url, PARSED)
+
+    def rejected(self, url):
+        self.set_status(url, REJECTED)
+
+    def failed(self, url, error):
+        self.set_status(url, FAILED, str(error))
+
+    def written(self, urls):
+        """Record products saved to teas.db, by the URL of their page."""
+        with self._lock:
+            self.connection.executemany("""
+                UPDATE Pages SET Status = ?, UpdatedDate = ? WHERE RunID = ? AND URL = ?
+                """, [(WRITTEN, now(), self.run_id, url) for url in urls])
+
+    def scraper_failed(self, source, error):
+        """Record the scraper for source ending with an error."""
+        self._execute("""
+            INSERT INTO Failures (RunID, Source, Error, UpdatedDate) VALUES (?, ?, ?, ?)
+            ON CONFLICT (RunID, Source) DO UPDATE SET
+                Error = excluded.Error,
+                UpdatedDate = excluded.UpdatedDate
+            """, (self.run_id, source, str(error), now()))
+
+    def counts(self):
+        """Number of pages per status."""
+        with self._lock:
+            return dict(self.connection.execute(
+                "SELECT Status, COUNT(*) FROM Pages WHERE RunID = ? GROUP BY Status", (self.run_id,)).fetchall())
+
+    def finish(self):
+        self._execute("UPDATE Runs SET Status = ?, FinishedDate = ? WHERE ID = ?", (FINISHED, now(), self.run_id))
+
+    def close(self):
+        self.connection.close()
+
+
+def connect(path):
+    """
+        Open the state file, creating its tables on first use.  Each update is committed on its own so a crash keeps every
+            checkpoint written before it.  WAL with synchronous=OFF keeps those commits cheap; a power loss can lose the
+            last few, which only means those pages are handled again.
+    """
+    connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=OFF")
+    for sql in SCHEMA:
+        connection.execute(sql)
+    return connection
+
+
+def open_run(path, resume=False):
+    """
+        Start a new run, or with resume=True continue the latest run that didn't finish.  Resuming when every run has
+            finished starts a new one.  Returns a CrawlRun.
+    """
+    connection = connect(path)
+    if resume:
+        row = connection.execute("SELECT ID FROM Runs WHERE Status = ? ORDER BY ID DESC LIMIT 1", (RUNNING,)).fetchone()
+        if row:
+            return CrawlRun(connection, row[0], resumed=True)
+
+    run_id = connection.execute("INSERT INTO Runs (StartedDate, Status) VALUES (?, ?)", (now(), RUNNING)).lastrowid
+
+    # Drop runs beyond the last KEEP_RUNS.
+    connection.execute("DELETE FROM Pages WHERE RunID <= ?", (run_id - KEEP_RUNS,))
+    connection.execute("DELETE FROM Failures WHERE RunID <= ?", (run_id - KEEP_RUNS,))
+    connection.execute("DELETE FROM Runs WHERE ID <= ?", (run_id - KEEP_RUNS,))
+    return CrawlRun(connection, run_id)
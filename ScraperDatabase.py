@@ -9,12 +9,105 @@
 """
 
 from cs50 import SQL
+import collections
+import contextlib
 import sqlite3
 import datetime
 from ScraperTemplates.CommonScraper import MAX_AGE_BEFORE_DEACTIVATE
+import teas.helpers.DatabaseFunctions as DatabaseProfile
 
 # Point database to the teas.db sqlite database.
-DB = SQL("sqlite:///teas.db")
+DB_PATH = "teas.db"
+
+
+def open_connection(**kwargs):
+    """
+        Connection factory for teas.db.  Every connection, the cs50 wrapper's included, gets the sqlite profile shared
+            with the web app (WAL journaling, busy timeout, ...), so pages keep being served while the scraper writes.
+    """
+    return DatabaseProfile.open_connection(DB_PATH, **kwargs)
+
+
+# SQLAlchemy (under cs50) may hand a pooled connection to another thread, as its own sqlite connections allow.
+DB = SQL("sqlite:///" + DB_PATH, creator=lambda: open_connection(check_same_thread=False))
+
+# Rewritten after every run.  The web app caches pages until this file changes (see teas/helpers/CacheFunctions.py).
+CATALOG_VERSION_PATH = "catalog.version"
+
+# Denormalized copy of TeasSourcesView read by the web app (teas.models.Catalog), and the shadow table it is rebuilt in.
+CATALOG_TABLE = "Catalog"
+CATALOG_SHADOW_TABLE = "Catalog__new"
+
+
+def connect():
+    """
+        Open a plain sqlite3 connection to teas.db for batch work the cs50 wrapper can't do (executemany, explicit
+            transactions).  Rows come back as sqlite3.Row so columns can still be read by name.
+        Transactions are controlled by the caller with BEGIN/COMMIT.
+    """
+    connection = open_connection(isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    return connection
+
+
+class LookupCache:
+    """
+        In-process copy of the lookup rows needed for every product written: TeaTypes and Sources IDs by name, and the
+            Name -> ID map of Teas.
+        Loaded once at the start of a scraper run (see lookup_cache()) and kept current as new teas are inserted.  While
+            not loaded, the get_... helpers query the database as usual.
+    """
+    def __init__(self):
+        self.loaded = False
+        self.tea_types = {}
+        self.sources = {}
+        self.teas = {}
+
+    def load(self, connection=None):
+        """Read the lookup tables into memory.  Returns the cache so it can be loaded and used in one line."""
+        own_connection = connection is None
+        if own_connection:
+            connection = connect()
+        try:
+            self.tea_types = {row["TeaType"]: row["ID"] for row in connection.execute("SELECT ID, TeaType FROM TeaTypes")}
+            self.sources = {row["SourceName"]: row["ID"] for row in connection.execute("SELECT ID, SourceName FROM Sources")}
+            self.teas = {row["Name"]: row["ID"] for row in connection.execute("SELECT ID, Name FROM Teas")}
+        finally:
+            if own_connection:
+                connection.close()
+        self.loaded = True
+        return self
+
+    def clear(self):
+        """Drop the cached rows so later calls go back to the database."""
+        self.loaded = False
+        self.tea_types = {}
+        self.sources = {}
+        self.teas = {}
+
+    def add_tea(self, name, tea_id):
+        """Record a newly inserted tea.  Only call once the insert is committed."""
+        if self.loaded:
+            self.teas[name] = tea_id
+
+
+# Lookup cache shared by all helpers for the duration of a scraper run.
+CACHE = LookupCache()
+
+
+@contextlib.contextmanager
+def lookup_cache():
+    """
+        Load the shared lookup cache for the length of a scraper run:
+            with lookup_cache():
+                ...
+        The cache is always cleared on exit, including when the run fails, so stale IDs never outlive the run.
+    """
+    CACHE.load()
+    try:
+        yield CACHE
+    finally:
+        CACHE.clear()
 
 
 def convert_boolean_to_db_bool(value):
@@ -31,7 +124,12 @@ def db_now():
             2.2: https://www.sqlite.org/datatype3.html
     """
     
-    return datetime.datetime.strftime(datetime.datetime.now(), "%Y-%m-%d %H:%M:%S")
+    return db_date(datetime.datetime.now())
+
+
+def db_date(value):
+    """Format a Python datetime the way dates are stored in the database (see db_now)."""
+    return datetime.datetime.strftime(value, "%Y-%m-%d %H:%M:%S")
 
 
 class ProductDB:
@@ -55,6 +153,8 @@ class ProductDB:
         
 def get_tea_types():
     """Query to select all product classifications"""
+    if CACHE.loaded:
+        return list(CACHE.tea_types.keys())
     data = DB.execute("""
         SELECT TeaType 
         FROM TeaTypes"""
@@ -64,6 +164,8 @@ def get_tea_types():
 
 def get_tea_types_by_type(tea_type):
     """Query to select all products of a given classification"""
+    if CACHE.loaded:
+        return CACHE.tea_types.get(tea_type)
     data = DB.execute("""
         SELECT ID
         FROM TeaTypes
@@ -79,6 +181,8 @@ def get_tea_types_by_type(tea_type):
 
 def get_tea_sources_by_name(source_name):
     """Query to select all products from a given datasource"""
+    if CACHE.loaded:
+        return CACHE.sources.get(source_name)
     data = DB.execute("""
         SELECT ID
         FROM Sources
@@ -110,6 +214,9 @@ def get_tea_by_source_product(source_name, product_id):
 
 
 def get_teas_by_name(name):
+    # Every tea inserted during a run is added to the cache, so a cache miss means the tea does not exist yet.
+    if CACHE.loaded:
+        return CACHE.teas.get(name)
     data = DB.execute("""
         SELECT ID
         FROM Teas
@@ -124,24 +231,6 @@ def get_teas_by_name(name):
     return None
 
 
-def get_teas_active():
-    data = DB.execute("""
-        SELECT ID, LastUpdatedDate
-        FROM TeasSources
-        WHERE IsAvailable = 1
-        """
-        )
-    
-    # Convert datetime string into Python datetime
-    for tea in data:
-        tea["LastUpdatedDate"] = datetime.datetime.strptime(tea["LastUpdatedDate"], "%Y-%m-%d %H:%M:%S")
-    
-    # Return the db value if collected else return None.  Assume only one ID per product name per database restriction.
-    if len(data) > 0:
-        return data
-    return None
-
-
 def insert_update_tea_name(name, tea_type, description):
     """Given a product and details, create if doesn't exist or update if does exist."""
     
@@ -175,7 +264,10 @@ def insert_update_tea_name(name, tea_type, description):
             date=db_now()
     )
     
-    return get_teas_by_name(name=name)
+    # Look up the new ID in the database (the lookup cache doesn't know this tea yet) and remember it for the run.
+    tea_id = DB.execute("SELECT ID FROM Teas WHERE Name = :teaname", teaname=name)[0]["ID"]
+    CACHE.add_tea(name, tea_id)
+    return tea_id
 
 
 def insert_update_product(tea_name, tea_type, tea_description, source_name, product_id, cost, url, image_url, is_available=True):
@@ -227,23 +319,280 @@ def insert_update_product(tea_name, tea_type, tea_description, source_name, prod
         )
 
 
-def deactivate_products():
-    """For any products no longer actively available on our scrapers, deactive the products from user view on the website."""
-    teas_deactivate = []
-    for tea in get_teas_active():
-        # Add to list to deactivate if tea is older than a certain date.
-        if tea["LastUpdatedDate"] < datetime.datetime.now() - datetime.timedelta(days=MAX_AGE_BEFORE_DEACTIVATE):
-            teas_deactivate.append(tea["ID"])
+def select_tea_ids(connection, names):
+    """Return a Name -> ID map for the given tea names.  Queried in chunks to stay under sqlite's variable limit."""
+    names = list(names)
+    tea_ids = {}
+    for start in range(0, len(names), 500):
+        chunk = names[start:start + 500]
+        data = connection.execute(
+            "SELECT ID, Name FROM Teas WHERE Name IN ({params})".format(params=", ".join("?" * len(chunk))), chunk)
+        tea_ids.update({row["Name"]: row["ID"] for row in data})
+    return tea_ids
+
+
+# Result of bulk_upsert_products: products written (changed or only marked as seen), products that changed, and the
+# page URLs of the products written.
+UpsertResult = collections.namedtuple("UpsertResult", ["saved", "changed", "urls"])
+
+
+def select_content_hashes(connection, source_ids):
+    """Return a (SourceID, ProductID) -> ContentHash map of the available products from the given sources."""
+    source_ids = list(source_ids)
+    data = connection.execute("""
+        SELECT SourceID, ProductID, ContentHash
+        FROM TeasSources
+        WHERE IsAvailable = 1 AND SourceID IN ({params})
+        """.format(params=", ".join("?" * len(source_ids))), source_ids)
+    return {(row["SourceID"], row["ProductID"]): row["ContentHash"] for row in data}
+
+
+def bulk_upsert_products(products, update_date=None, incremental=False):
+    """
+        Insert or update a batch of scraped products (CommonScraper.Product objects) in a single transaction.
+        Teas are upserted on their unique Name and TeasSources on the unique (SourceID, ProductID) pair, so each table
+            takes one executemany regardless of batch size.
+        With incremental=True, products whose content hash (Product.fingerprint) matches the stored one only have their
+            LastUpdatedDate bumped, so deactivate_products still sees them, and the rest of the row is left alone.
+        Products with a tea type or datasource not yet in the database are skipped, and left out of the result's urls.
+            Returns an UpsertResult.
+    """
+    update_date = update_date or db_now()
+    
+    connection = connect()
+    try:
+        connection.execute("BEGIN IMMEDIATE")
+        
+        # Resolve tea types, datasources and existing teas from the run's lookup cache, or load them once for this batch.
+        lookup = CACHE if CACHE.loaded else LookupCache().load(connection)
+        products = [product for product in products
+                    if product.type in lookup.tea_types and product.source in lookup.sources]
+        saved = len(products)
+        urls = [product.url for product in products]
+        fingerprints = {id(product): product.fingerprint() for product in products}
+        
+        # Split off the products that haven't changed since they were last written.
+        if incremental and products:
+            stored_hashes = select_content_hashes(connection, {lookup.sources[product.source] for product in products})
+            unchanged = []
+            changed = []
+            for product in products:
+                key = (lookup.sources[product.source], product.id)
+                if stored_hashes.get(key) == fingerprints[id(product)]:
+                    unchanged.append(key)
+                else:
+                    changed.append(product)
+            products = changed
+            
+            connection.executemany("""
+                UPDATE TeasSources SET LastUpdatedDate = ? WHERE SourceID = ? AND ProductID = ?
+                """
+                , [(update_date, source_id, product_id) for source_id, product_id in unchanged]
+                )
+        
+        connection.executemany("""
+            INSERT INTO Teas (Name, TeaTypeID, Description, LastUpdatedDate)
+            VALUES(:name, :teatypeid, :description, :date)
+            ON CONFLICT (Name) DO UPDATE SET
+                TeaTypeID = excluded.TeaTypeID,
+                Description = excluded.Description,
+                LastUpdatedDate = excluded.LastUpdatedDate
+            """
+            , [{"name": product.name, "teatypeid": lookup.tea_types[product.type], "description": product.description,
+                "date": update_date} for product in products]
+            )
+        
+        # Look up IDs only for teas that were new to this batch.
+        new_tea_ids = select_tea_ids(connection, {product.name for product in products} - lookup.teas.keys())
+        tea_ids = dict(lookup.teas, **new_tea_ids)
+        
+        connection.executemany("""
+            INSERT INTO TeasSources (TeaID, SourceID, ProductID, CostOz, URL, ImageURL, IsAvailable, LastUpdatedDate,
+                ContentHash)
+            VALUES(:teaid, :sourceid, :productid, :cost, :url, :imageurl, :isavailable, :date, :contenthash)
+            ON CONFLICT (SourceID, ProductID) DO UPDATE SET
+                TeaID = excluded.TeaID,
+                CostOz = excluded.CostOz,
+                URL = excluded.URL,
+                ImageURL = excluded.ImageURL,
+                IsAvailable = excluded.IsAvailable,
+                LastUpdatedDate = excluded.LastUpdatedDate,
+                ContentHash = excluded.ContentHash
+            """
+            , [{"teaid": tea_ids[product.name], "sourceid": lookup.sources[product.source], "productid": product.id,
+                "cost": product.cost, "url": product.url, "imageurl": product.image,
+                "isavailable": convert_boolean_to_db_bool(True), "date": update_date,
+                "contenthash": fingerprints[id(product)]} for product in products]
+            )
+        
+        connection.execute("COMMIT")
+        
+        # Only cache the new IDs once they are committed.
+        for name, tea_id in new_tea_ids.items():
+            lookup.add_tea(name, tea_id)
+    except:
+        connection.execute("ROLLBACK")
+        raise
+    finally:
+        connection.close()
+    
+    return UpsertResult(saved=saved, changed=len(products), urls=urls)
+
+
+def deactivate_products(dry_run=False, skip_sources=()):
+    """
+        For any products no longer actively available on our scrapers, deactive the products from user view on the website.
+        A product is stale once it has gone MAX_AGE_BEFORE_DEACTIVATE days without an update.  Stale products are
+            deactivated with a single UPDATE, served by the (IsAvailable, LastUpdatedDate) index.
+        Returns the number of products deactivated per source name.  With dry_run=True nothing is changed and the counts
+            report what would be deactivated.
+        Products of the sources named in skip_sources are left alone, ex. the sources whose scraper failed this run.
+    """
+    cutoff = db_date(datetime.datetime.now() - datetime.timedelta(days=MAX_AGE_BEFORE_DEACTIVATE))
+    # One named parameter per skipped source.  sqlite accepts the empty list, "NOT IN ()", when there are none.
+    parameters = {"cutoff": cutoff}
+    parameters.update(("skip{index}".format(index=index), source) for index, source in enumerate(skip_sources))
+    skipped = ", ".join(":skip{index}".format(index=index) for index in range(len(skip_sources)))
     
-    # Deactivate any teas in the list
-    if len(teas_deactivate) > 0:
-        for tea in teas_deactivate:
-            DB.execute("""
+    connection = connect()
+    try:
+        connection.execute("BEGIN IMMEDIATE")
+        
+        # Count the stale products per source first so the report matches what the update changes.
+        data = connection.execute("""
+            SELECT source.SourceName, COUNT(*) AS Deactivated
+            FROM TeasSources tea_source
+            JOIN Sources source ON tea_source.SourceID = source.ID
+            WHERE
+                    tea_source.IsAvailable = 1
+                AND tea_source.LastUpdatedDate < :cutoff
+                AND source.SourceName NOT IN ({skipped})
+            GROUP BY source.SourceName
+            """.format(skipped=skipped)
+            , parameters
+            )
+        deactivated = {row["SourceName"]: row["Deactivated"] for row in data}
+        
+        if deactivated and not dry_run:
+            connection.execute("""
                 UPDATE TeasSources
                 SET IsAvailable = 0
-                WHERE ID = :teaidstr
-                """, teaidstr=tea
-            )
+                WHERE
+                        IsAvailable = 1
+                    AND LastUpdatedDate < :cutoff
+                    AND SourceID NOT IN (SELECT ID FROM Sources WHERE SourceName IN ({skipped}))
+                """.format(skipped=skipped)
+                , parameters
+                )
+        
+        connection.execute("COMMIT")
+    except:
+        connection.execute("ROLLBACK")
+        raise
+    finally:
+        connection.close()
+    
+    return deactivated
+
+
+def rebuild_catalog():
+    """
+        Rebuild the Catalog table from TeasSourcesView (the available products) so the web app reads the run's results
+            without evaluating the join on every request.
+        The new rows are written to a shadow table that replaces Catalog in the same transaction, so pages keep reading
+            the previous catalog until the new one is committed.  The table and index definitions are copied from
+            Catalog itself (created by migration 0029), so they follow the teas.models.Catalog migrations.  sqlite
+            can't rename an index, so the indexes are recreated after the swap, still inside the transaction.
+        Clears CatalogState.Dirty and counts the rebuild in CatalogState.Version in the same transaction (see
+            migration 0030).
+        Returns the number of products in the catalog.
+    """
+    connection = connect()
+    try:
+        connection.execute("BEGIN IMMEDIATE")
+        
+        schema = connection.execute(
+            "SELECT type, sql FROM sqlite_master WHERE tbl_name = ? AND sql IS NOT NULL", (CATALOG_TABLE,)).fetchall()
+        table_sql = [row["sql"] for row in schema if row["type"] == "table"][0]
+        index_sql = [row["sql"] for row in schema if row["type"] == "index"]
+        columns = ", ".join('"{name}"'.format(name=row["name"])
+                            for row in connection.execute('PRAGMA table_info("{table}")'.format(table=CATALOG_TABLE)))
+        
+        connection.execute('DROP TABLE IF EXISTS "{shadow}"'.format(shadow=CATALOG_SHADOW_TABLE))
+        connection.execute(table_sql.replace('"{table}"'.format(table=CATALOG_TABLE),
+                                             '"{shadow}"'.format(shadow=CATALOG_SHADOW_TABLE), 1))
+        # Written in cost order, the order the pages read it in.
+        connection.execute("""
+            INSERT INTO "{shadow}" ({columns})
+            SELECT {columns}
+            FROM TeasSourcesView
+            ORDER BY CostOz, ID
+            """.format(shadow=CATALOG_SHADOW_TABLE, columns=columns))
+        count = connection.execute('SELECT COUNT(*) FROM "{shadow}"'.format(shadow=CATALOG_SHADOW_TABLE)).fetchone()[0]
+        
+        connection.execute('DROP TABLE "{table}"'.format(table=CATALOG_TABLE))
+        connection.execute('ALTER TABLE "{shadow}" RENAME TO "{table}"'.format(
+            shadow=CATALOG_SHADOW_TABLE, table=CATALOG_TABLE))
+        for sql in index_sql:
+            connection.execute(sql)
+        connection.execute('UPDATE "CatalogState" SET Dirty = 0, Version = Version + 1')
+        
+        connection.execute("COMMIT")
+    except:
+        connection.execute("ROLLBACK")
+        raise
+    finally:
+        connection.close()
+    
+    return count
+
+
+def analyze_database():
+    """
+        Refresh sqlite's table statistics after a run so the query planner keeps choosing the right indexes as the
+            catalog grows (e.g. driving searches from the TeasSearch full-text index).
+    """
+    connection = connect()
+    try:
+        connection.execute("ANALYZE")
+    finally:
+        connection.close()
+
+
+def catalog_state():
+    """
+        The CatalogState row: Dirty is set by triggers whenever TeasSourcesView may have changed since the last
+            rebuild_catalog(), from any connection, and Version counts the rebuilds.
+    """
+    connection = connect()
+    try:
+        return connection.execute('SELECT Dirty, Version FROM "CatalogState"').fetchone()
+    finally:
+        connection.close()
+
+
+def catalog_dirty():
+    """True if the Catalog table is behind TeasSourcesView and needs rebuild_catalog()."""
+    return bool(catalog_state()["Dirty"])
+
+
+def bump_catalog_version():
+    """
+        Mark the catalog as changed so the web app drops its cached pages, if the version file is behind the last Catalog
+            rebuild (CatalogState.Version).  Comparing the two, rather than bumping right after a rebuild, means a run
+            that dies between the rebuild and the bump is caught up by the next one.
+        Returns the version written, or None if the file was already current.
+    """
+    version = str(catalog_state()["Version"])
+    try:
+        with open(CATALOG_VERSION_PATH) as version_file:
+            if version_file.read().strip() == version:
+                return None
+    except FileNotFoundError:
+        pass
+    with open(CATALOG_VERSION_PATH, "w") as version_file:
+        version_file.write(version + "\n")
+    return version
 
 
 def _test(testing_db=False):
@@ -289,4 +638,4 @@ def _test(testing_db=False):
 
 
 if __name__ == '__main__':
-    _test(testing_db=False)
\ No newline at end of file
+    _test(testing_db=False)
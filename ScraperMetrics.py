@@ -0,0 +1,257 @@
+"""
+    ScraperMetrics.py
+    Purpose: timings and counters for each scraper run, written out as a JSON run report and optionally as a
+        Prometheus textfile (for node_exporter's textfile collector).
+
+    Scraper.main() starts a new RunMetrics (start_run()) and the scraper modules record into the current one through
+        METRICS:
+            fetch latency per host (histogram), failed fetches and retries per host     CommonScraper.fetch_html
+            pages skipped per host while the host's circuit breaker is open             CommonScraper.fetch_html
+            page parse time per host (histogram)                                        CommonScraper.parse_page
+            product extraction time per source (histogram)                              template get_products()
+            products accepted, and rejected by reason, per source                       template make_product()
+            database time per stage (upsert, deactivate, catalog, analyze)              Scraper.main
+            products written per result (saved, changed, deactivated)                   Scraper.main
+            scrapers that ended with an error, per source                               Scraper.main
+    Recording is thread safe, since pages are fetched and parsed on the CommonScraper fetch engine's worker threads.
+"""
+
+import contextlib
+import json
+import os
+import threading
+import time
+import urllib.parse
+
+# Histogram bucket upper bounds, in seconds.
+FETCH_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+PARSE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+PROMETHEUS_PREFIX = "teafinder_scraper"
+
+
+class Histogram:
+    """Count of observations per bucket, with their total and maximum."""
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def cumulative(self):
+        """(upper bound, observations at or below it) pairs, ending with ("+Inf", count)."""
+        total = 0
+        pairs = []
+        for bound, count in zip(list(self.buckets) + ["+Inf"], self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+    def report(self):
+        return {
+            "count": self.count,
+            "sum_seconds": round(self.sum, 4),
+            "mean_ms": round(self.sum * 1000 / self.count, 3) if self.count else None,
+            "max_ms": round(self.max * 1000, 3),
+            "buckets": [[bound, count] for bound, count in self.cumulative()]
+            }
+
+
+def host(url):
+    return urllib.parse.urlsplit(url).netloc
+
+
+class RunMetrics:
+    """Measurements for one scraper run."""
+    def __init__(self):
+        self.started = time.time()
+        self.finished = None
+        self.fetch = {}
+        self.fetch_errors = {}
+        self.retries = {}
+        self.skipped = {}
+        self.parse = {}
+        self.extract = {}
+        self.accepted = {}
+        self.rejected = {}
+        self.database = {}
+        self.written = {}
+        self.failed = {}
+        self._lock = threading.Lock()
+
+    def observe_fetch(self, url, seconds, ok=True):
+        """Record one page request.  Failed requests count as fetch errors and are timed like the others."""
+        with self._lock:
+            self.fetch.setdefault(host(url), Histogram(FETCH_BUCKETS)).observe(seconds)
+            if not ok:
+                self.fetch_errors[host(url)] = self.fetch_errors.get(host(url), 0) + 1
+
+    def count_retry(self, url):
+        with self._lock:
+            self.retries[host(url)] = self.retries.get(host(url), 0) + 1
+
+    def count_skipped(self, url):
+        """Record a page not requested because its host's circuit breaker is open."""
+        with self._lock:
+            self.skipped[host(url)] = self.skipped.get(host(url), 0) + 1
+
+    def observe_parse(self, url, seconds):
+        """Record the time taken to parse a downloaded page into a tree."""
+        with self._lock:
+            self.parse.setdefault(host(url), Histogram(PARSE_BUCKETS)).observe(seconds)
+
+    def observe_extract(self, source, seconds):
+        """Record the time a template took to read a product out of a parsed page."""
+        with self._lock:
+            self.extract.setdefault(source, Histogram(PARSE_BUCKETS)).observe(seconds)
+
+    def accept(self, source):
+        with self._lock:
+            self.accepted[source] = self.accepted.get(source, 0) + 1
+
+    def reject(self, source, reason):
+        """Record a product page that didn't give a usable product, ex. reason "missing_cost" or "unmapped_type"."""
+        with self._lock:
+            reasons = self.rejected.setdefault(source, {})
+            reasons[reason] = reasons.get(reason, 0) + 1
+
+    @contextlib.contextmanager
+    def time_database(self, stage, products=0):
+        """Time a block of database work under stage, ex. "upsert"."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                totals = self.database.setdefault(stage, {"calls": 0, "seconds": 0.0, "products": 0})
+                totals["calls"] += 1
+                totals["seconds"] += elapsed
+                totals["products"] += products
+
+    def count_written(self, **counts):
+        """Add to the database write totals, ex. count_written(saved=100, changed=3)."""
+        with self._lock:
+            for name, count in counts.items():
+                self.written[name] = self.written.get(name, 0) + count
+
+    def scraper_failed(self, source, error):
+        """Record a scraper that ended with an error instead of reading its whole website."""
+        with self._lock:
+            self.failed[source] = str(error)
+
+    def finish(self):
+        self.finished = time.time()
+
+    def report(self):
+        """The run as a JSON-serializable dict."""
+        with self._lock:
+            return {
+                "started": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.started)),
+                "duration_seconds": round((self.finished or time.time()) - self.started, 3),
+                "fetch": {name: histogram.report() for name, histogram in self.fetch.items()},
+                "fetch_errors": dict(self.fetch_errors),
+                "retries": dict(self.retries),
+                "skipped": dict(self.skipped),
+                "parse": {name: histogram.report() for name, histogram in self.parse.items()},
+                "extract": {name: histogram.report() for name, histogram in self.extract.items()},
+                "products": {
+                    source: {
+                        "accepted": self.accepted.get(source, 0),
+                        "rejected": dict(self.rejected.get(source, {}))
+                        }
+                    for source in sorted(set(self.accepted) | set(self.rejected))
+                    },
+                "database": {
+                    stage: dict(totals, seconds=round(totals["seconds"], 4)) for stage, totals in self.database.items()
+                    },
+                "written": dict(self.written),
+                "failed": dict(self.failed)
+                }
+
+    def write_report(self, path):
+        write_atomic(path, json.dumps(self.report(), indent=4, sort_keys=True) + "\n")
+
+    def prometheus(self):
+        """The run in the Prometheus text exposition format."""
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            full_name = "{prefix}_{name}".format(prefix=PROMETHEUS_PREFIX, name=name)
+            lines.append("# HELP {name} {help}".format(name=full_name, help=help_text))
+            lines.append("# TYPE {name} {kind}".format(name=full_name, kind=kind))
+            for suffix, labels, value in samples:
+                label_text = ",".join('{key}="{value}"'.format(key=key, value=str(value).replace('"', '\\"'))
+                                      for key, value in labels)
+                lines.append("{name}{suffix}{labels} {value}".format(
+                    name=full_name, suffix=suffix, labels="{" + label_text + "}" if label_text else "", value=value))
+
+        def histogram_samples(label, histograms):
+            samples = []
+            for name, histogram in sorted(histograms.items()):
+                for bound, count in histogram.cumulative():
+                    samples.append(("_bucket", [(label, name), ("le", bound)], count))
+                samples.append(("_sum", [(label, name)], round(histogram.sum, 6)))
+                samples.append(("_count", [(label, name)], histogram.count))
+            return samples
+
+        with self._lock:
+            metric("last_run_timestamp_seconds", "gauge", "Start time of the last scraper run.",
+                   [("", [], round(self.started))])
+            metric("run_duration_seconds", "gauge", "Duration of the last scraper run.",
+                   [("", [], round((self.finished or time.time()) - self.started, 3))])
+            metric("fetch_seconds", "histogram", "Page request latency.", histogram_samples("host", self.fetch))
+            metric("fetch_errors", "gauge", "Page requests that failed.",
+                   [("", [("host", name)], count) for name, count in sorted(self.fetch_errors.items())])
+            metric("retries", "gauge", "Page requests retried.",
+                   [("", [("host", name)], count) for name, count in sorted(self.retries.items())])
+            metric("skipped", "gauge", "Page requests skipped while the host's circuit breaker was open.",
+                   [("", [("host", name)], count) for name, count in sorted(self.skipped.items())])
+            metric("parse_seconds", "histogram", "Time to parse a page.", histogram_samples("host", self.parse))
+            metric("extract_seconds", "histogram", "Time to read a product from a parsed page.",
+                   histogram_samples("source", self.extract))
+            metric("products_accepted", "gauge", "Products read from the websites.",
+                   [("", [("source", name)], count) for name, count in sorted(self.accepted.items())])
+            metric("products_rejected", "gauge", "Product pages without a usable product, by reason.",
+                   [("", [("source", name), ("reason", reason)], count)
+                    for name, reasons in sorted(self.rejected.items()) for reason, count in sorted(reasons.items())])
+            metric("database_seconds", "gauge", "Time spent in the database, by stage.",
+                   [("", [("stage", stage)], round(totals["seconds"], 6))
+                    for stage, totals in sorted(self.database.items())])
+            metric("products_written", "gauge", "Products written to the database, by result.",
+                   [("", [("result", name)], count) for name, count in sorted(self.written.items())])
+            metric("scraper_failed", "gauge", "Scrapers that ended with an error, by source.",
+                   [("", [("source", name)], 1) for name in sorted(self.failed)])
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        write_atomic(path, self.prometheus())
+
+
+def write_atomic(path, text):
+    """Write through a temporary file so readers (ex. node_exporter) never see a partial file."""
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w") as output:
+        output.write(text)
+    os.replace(temporary_path, path)
+
+
+# Metrics for the current run.  Replaced by start_run() at the start of each run.
+METRICS = RunMetrics()
+
+
+def start_run():
+    """Start recording a new run.  Returns its RunMetrics."""
+    global METRICS
+    METRICS = RunMetrics()
+    return METRICS
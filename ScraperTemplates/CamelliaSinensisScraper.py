@@ -10,13 +10,20 @@
     Created Date: 12/8/2016
 """
 
+import math
 import re
 
-from ScraperTemplates.CommonScraper import Product, parse_page, grams_to_oz
+import lxml.etree
+
+import ScraperMetrics as Metrics
+from ScraperTemplates.CommonScraper import Product, parse_page, fetch_pages, fetch_products, grams_to_oz, page_parser, \
+    has_class, element_string, first, missing_detail, set_rate_limit, ListingError
 
 # set config
 MAIN_URL = "http://camellia-sinensis.com/en/tea?limit=100&mode=list&p="
 MAX_BASE_PAGES = 25
+ITEM_COUNT_PATTERN = re.compile(r"Items (\d+) to (\d+) of (\d+) total")
+RATE_LIMIT = 4                  # max requests per second to the website (see CommonScraper.RateLimiter)
 PARSER = "lxml"
 SOURCE = 'Camellia Sinensis'
 TEA_TYPE_MAP = {
@@ -35,164 +42,244 @@ HTML_VALUE_REPLACEMENT = {
     "&#8232": ""
 }
 
+set_rate_limit(MAIN_URL, RATE_LIMIT)
+
+# Product page XPath expressions for the "xpath" parse backend (see parse_product_tree).  Compiled once per run.
+PRODUCT_XPATH = {
+    "code": lxml.etree.XPath("//p[{cls}]".format(cls=has_class("product-code"))),
+    "details": lxml.etree.XPath("//div[@id='right-column']"),
+    "name": lxml.etree.XPath(".//p[{cls}]".format(cls=has_class("name"))),
+    "description": lxml.etree.XPath("(.//div[{cls}])[1]//p".format(cls=has_class("description"))),
+    "family": lxml.etree.XPath(".//p[{cls}]".format(cls=has_class("family"))),
+    "cost": lxml.etree.XPath(".//option[@data-saleable and @value]"),
+    "images": lxml.etree.XPath("(//div[@id='left-column'])[1]//a[{cls}]/@href".format(cls=has_class("img-overlay")))
+    }
+
+
+def parse_listing_links(soup):
+    """Return the product URLs on a product list page."""
+    
+    # Get all product details stoed in a div tag.  Pull out any URLs assumed to be product URLs.
+    def parse_product_url(tag):
+        """
+            Return True if a given HTML tag contains a product URL.
+            bs4 documentation: https://www.crummy.com/software/BeautifulSoup/bs4/doc/#a-function
+        """
+        if tag is None:
+            return False
+        elif tag.has_attr("class") and tag.has_attr("href") and tag.has_attr("title"):
+            return tag["href"]
+        else:
+            return False
+    
+    # For each product, parse the product URLs.
+    product_links = []
+    for details in soup.find_all("div", class_="infos clearfix"):
+        for link_tag in details.find_all("a"):
+            if parse_product_url(link_tag):
+                product_links.append(parse_product_url(link_tag))
+    return product_links
+
 
-def get_product_links():
+def parse_item_count(soup):
     """
-        Get links to all available products from Camellia Sinensis.
-        Website maxes at 100 items per page.  After accessing the last page, website returns the last page again.
-            Iterate over unknown number of pages until we get repeat data.
+        Return (first item, last item, total items) from a product list page, or None if the count isn't shown.
+        The count is included in a span tag, ex. "Items 1 to 100 of 250 total".
+    """
+    for item in soup.find_all("span"):
+        count = ITEM_COUNT_PATTERN.match((item.string or "").strip())
+        if count:
+            return tuple(int(value) for value in count.groups())
+    return None
+
+
+def get_product_links(missing=None):
     """
+        Yield links to all available products from Camellia Sinensis as the product list pages arrive, so product pages
+            can be fetched while the rest of the list is still downloading.
+        Website maxes at 100 items per page.  The first page's item count ("Items 1 to 100 of 250 total") gives the
+            number of pages, and the remaining pages are fetched concurrently.  If the count can't be read, pages are
+            walked one at a time until one adds no new links (after the last page, the website returns it again).
+        List pages that could not be retrieved are added to the missing list if given.
+    """
+    missing = [] if missing is None else missing
+    seen = set()
     
-    # Keep a count of the number of items found and the page number
-    reviewed_items = 0
-    page_num = 1
-    product_links = []
+    def new_links(soup):
+        links = [link for link in parse_listing_links(soup) if link not in seen]
+        seen.update(links)
+        return links
     
-    # Iterate until we receive a duplicate page as the prior page or until a large number of pages accessed (to 
-    # prevent any loops caused by changes to the unexpected changes to the webpage structure).
-    while page_num <= MAX_BASE_PAGES:
-        
-        # Parse the current product list page.  If no page retrieved or if parser changes, end loop.
-        url = MAIN_URL + str(page_num)
-        soup = parse_page(url, PARSER)
+    # Parse the first product list page.  If no page retrieved, there is nothing to scrape.
+    soup = parse_page(MAIN_URL + "1", PARSER)
+    if not soup:
+        missing.append(MAIN_URL + "1")
+        return
+    yield from new_links(soup)
+    
+    item_count = parse_item_count(soup)
+    if item_count:
+        first_item, last_item, total_items = item_count
+        page_count = min(MAX_BASE_PAGES, math.ceil(total_items / max(1, last_item - first_item + 1)))
+        for url, soup in fetch_pages([MAIN_URL + str(page_num) for page_num in range(2, page_count + 1)], PARSER):
+            if soup is not False:
+                yield from new_links(soup)
+            else:
+                missing.append(url)
+        return
+    
+    # No item count: walk the pages in order, up to a large number of pages (to prevent any loops caused by unexpected
+    # changes to the webpage structure).
+    for page_num in range(2, MAX_BASE_PAGES + 1):
+        soup = parse_page(MAIN_URL + str(page_num), PARSER)
         if not soup:
+            missing.append(MAIN_URL + str(page_num))
             break
-
-        # Parse product count for the current page and update the total products viewed.
-        # Product total is included in a span tag with item count "Items ###".  Iterate over
-        # all span tags to find the item count.
-        total = reviewed_items
-        total_items = soup.find_all("span")  
-        for item in total_items:
-            item_value = ""
-            if item.string:
-                item_value = item.string
-            total = re.match("Items (\d+)", item_value)
-            # if an item count is found, parse out the count and update the total.
-            if total:
-                total = int(total.group(1))
-                break
-        # If no new items on this page, stop looking for product URLs since we have reached the end.
-        if total <= reviewed_items:
+        links = new_links(soup)
+        if not links:
             break
-        else:
-            # Set page parameters for next loop
-            reviewed_items = total
-            page_num += 1
-
-        # Get all product details stoed in a div tag.  Pull out any URLs assumed to be product URLs.
-        def parse_product_url(tag):
-            """
-                Return True if a given HTML tag contains a product URL.
-                bs4 documentation: https://www.crummy.com/software/BeautifulSoup/bs4/doc/#a-function
-            """
-            if tag is None:
-                return False
-            elif tag.has_attr("class") and tag.has_attr("href") and tag.has_attr("title"):
-                return tag["href"]
-            else:
-                return False
-        
-        # For each product, parse the product URLs.
-        for details in soup.find_all("div", class_="infos clearfix"):
-            for link_tag in details.find_all("a"):
-                if parse_product_url(link_tag):
-                    product_links.append(parse_product_url(link_tag))
-
-    return product_links
+        yield from links
 
 
 def get_products(product_links):
     """
-        Given a list of product URLs, parse product pages to get product details.
-        Accepts a list of URL strings.    
+        Given product URLs, parse product pages to get product details.
+        Accepts any iterable of URL strings, read as it is consumed (ex. get_product_links()).  Pages are fetched
+            concurrently and parsed in the parse pool in the order they arrive (see CommonScraper.fetch_products).
+        Yields each Product as soon as its page is parsed.  Pages that could not be retrieved are skipped.
     """
+    parser = page_parser(PARSER)
+    parse = parse_product_tree if parser != PARSER else parse_product
+    for url, product in fetch_products(product_links, parse, parser, SOURCE):
+        if product:
+            Metrics.METRICS.accept(SOURCE)
+            
+            # Print for status updates as scraper runs.
+            print(product)
+            yield product
 
-    products = []
-    for url in product_links:
-        
-        # Attempt to parse the product URL
-        soup = parse_page(url, PARSER)
-        if not soup:
-            continue
 
-        # Parse the source's unique product ID.
-        id_string = soup.find("p", class_="product-code").string
-        id = re.search("PRODUCT CODE : (\S+)", id_string)
+def make_product(url, id, name, description, tea_type, cost_string, image_url):
+    """Clean up the raw values read from a product page and return a Product, or None if details are missing."""
+    if id:
+        id = re.search("PRODUCT CODE : (\S+)", id)
         if id:
             id = id.group(1)
+    
+    # Certain HTML characters have been known to appear on this website and cause cross-browser compatibility issues.
+    # Replace these values as they cause display issues in different browsers.
+    for html_val in HTML_VALUE_REPLACEMENT.keys():
+        if html_val in description:
+            description = description.replace(html_val, HTML_VALUE_REPLACEMENT[html_val])
+    
+    # Parse the tea classification.  We will only map those included in the config.
+    family = tea_type
+    if tea_type in TEA_TYPE_MAP.keys():
+        tea_type = TEA_TYPE_MAP[tea_type]
+    else:
+        tea_type = None
+    
+    # Calculate the unit cost in ounces.  This site quotes in grams, so convert to ounces for compatibility with our db.
+    cost = None
+    if cost_string:
+        cost = re.search("(\d+)g[ ]?[\xa0]?\$(\d+).(\d+)", cost_string)
+        if cost:
+            cost_dollars = int(cost.group(2)) + (float(cost.group(3)) / 100)
+            cost_weight = grams_to_oz(float(cost.group(1)))
+            cost = cost_dollars / cost_weight
+    
+    # If all details are pulled, store the product.  Image is optional.
+    # Otherwise record why it was skipped.  Unmapped types (ex. gift boxes) are expected, other gaps can mean the page
+    # layout has changed.
+    missing = missing_detail(name=name, type=tea_type, description=description, cost=cost, id=id)
+    if missing:
+        Metrics.METRICS.reject(SOURCE, "unmapped_type" if missing == "type" and family else "missing_" + missing)
+        return None
+    return Product(
+        name=name,
+        type=tea_type,
+        description=description,
+        cost=cost,
+        source=SOURCE,
+        id=id,
+        url=url,
+        image=image_url)
 
-        # Product details are generally kept on the right column of the website.
-        details = soup.find("div", id="right-column")
 
-        # Parse the product name and description from the right column.  String together all pararaphs of the description.
-        name = details.find("p", class_="name").string
-        description = " ".join(
-            [para.string for para in details.find("div", class_="description").find_all("p") if para.string])
-            
-        # Certain HTML characters have been known to appear on this website and cause cross-browser compatibility issues.
-        # Replace these values as they cause display issues in different browsers.
-        for html_val in HTML_VALUE_REPLACEMENT.keys():
-            if html_val in description:
-                description = description.replace(html_val, HTML_VALUE_REPLACEMENT[html_val])
-
-        # Parse the tea classification.  We will only map those included in the config.
-        tea_type = details.find("p", class_="family").string
-        if tea_type in TEA_TYPE_MAP.keys():
-            tea_type = TEA_TYPE_MAP[tea_type]
-        else:
-            tea_type = None
-
-        # Parse out the item cost from the cost dropdown on the page.  Take the first cost option (assuming it is the
-        # most expensive unit cost).  Calculate the unit cost in ounces.  This site quotes in grams, so convert to ounces
-        # for compatibility with our db.
-        # Ignore all teas sold in boxes, bags, or gift sets.  Only include bulk-sold loose-leaf tea.  Assume quoted in grams.
-        def is_cost_tag(tag):
-            """
-                Return True if a given HTML tag is from the page's cost dropdown.
-                bs4 documentation: https://www.crummy.com/software/BeautifulSoup/bs4/doc/#a-function
-            """
-            return tag.name == "option" and tag.has_attr("data-saleable") and tag.has_attr("value")
-            
-        cost = None
-        cost_tag = details.find(is_cost_tag)
-        if cost_tag:
-            cost = re.search("(\d+)g[ ]?[\xa0]?\$(\d+).(\d+)", cost_tag.string)
-            if cost:
-                cost_dollars = int(cost.group(2)) + (float(cost.group(3)) / 100)
-                cost_weight = grams_to_oz(float(cost.group(1)))
-                cost = cost_dollars / cost_weight
-        
-        # Images are all kept in the left column.  Go back to the original page parsed and look for the image overlay.
-        image_html = soup.find("div", id="left-column").find_all("a", class_="img-overlay")
-        image_url = ""
-        for tag in image_html:
-            if tag.has_attr("href"):
-                image_url = tag["href"]
-
-        # If all details are pulled, store the product.  Image is optional.
-        if name and tea_type and description and cost and id:
-            products.append(
-                Product(
-                    name=name,
-                    type=tea_type,
-                    description=description,
-                    cost=cost,
-                    source=SOURCE,
-                    id=id,
-                    url=url,
-                    image=image_url)
-                )
-            
-            # Print for status updates as scraper runs.
-            print(products[-1])
+def parse_product(url, soup):
+    """Read a product from its page's BeautifulSoup tree.  Returns a Product, or None if details are missing."""
+    # Parse the source's unique product ID.
+    id_string = soup.find("p", class_="product-code").string
+
+    # Product details are generally kept on the right column of the website.
+    details = soup.find("div", id="right-column")
+
+    # Parse the product name and description from the right column.  String together all pararaphs of the description.
+    name = details.find("p", class_="name").string
+    description = " ".join(
+        [para.string for para in details.find("div", class_="description").find_all("p") if para.string])
+
+    # Parse the tea classification.
+    tea_type = details.find("p", class_="family").string
+
+    # Parse out the item cost from the cost dropdown on the page.  Take the first cost option (assuming it is the
+    # most expensive unit cost).
+    # Ignore all teas sold in boxes, bags, or gift sets.  Only include bulk-sold loose-leaf tea.  Assume quoted in grams.
+    def is_cost_tag(tag):
+        """
+            Return True if a given HTML tag is from the page's cost dropdown.
+            bs4 documentation: https://www.crummy.com/software/BeautifulSoup/bs4/doc/#a-function
+        """
+        return tag.name == "option" and tag.has_attr("data-saleable") and tag.has_attr("value")
         
-    return products
+    cost_tag = details.find(is_cost_tag)
+    cost_string = cost_tag.string if cost_tag else None
+    
+    # Images are all kept in the left column.  Go back to the original page parsed and look for the image overlay.
+    image_html = soup.find("div", id="left-column").find_all("a", class_="img-overlay")
+    image_url = ""
+    for tag in image_html:
+        if tag.has_attr("href"):
+            image_url = tag["href"]
+
+    return make_product(url, id_string, name, description, tea_type, cost_string, image_url)
+
+
+def parse_product_tree(url, tree):
+    """
+        Read a product from its page's lxml tree with the PRODUCT_XPATH expressions (the "xpath" parse backend).
+        Reads the same elements as parse_product.  Returns a Product, or None if details are missing.
+    """
+    details = first(PRODUCT_XPATH["details"](tree))
+    if details is None:
+        return None
+
+    description = " ".join(
+        [string for string in (element_string(para) for para in PRODUCT_XPATH["description"](details)) if string])
+    image_urls = PRODUCT_XPATH["images"](tree)
+
+    return make_product(
+        url,
+        id=element_string(first(PRODUCT_XPATH["code"](tree))),
+        name=element_string(first(PRODUCT_XPATH["name"](details))),
+        description=description,
+        tea_type=element_string(first(PRODUCT_XPATH["family"](details))),
+        cost_string=element_string(first(PRODUCT_XPATH["cost"](details))),
+        image_url=image_urls[-1] if image_urls else "")
 
 
 def main():
-    return get_products(get_product_links())
+    """
+        Yield every available product from Camellia Sinensis.
+        Raises ListingError once the products are read if any product list page couldn't be retrieved.
+    """
+    missing = []
+    yield from get_products(get_product_links(missing))
+    if missing:
+        raise ListingError("could not read {count} product list pages: {urls}".format(
+            count=len(missing), urls=", ".join(missing)))
 
 
 if __name__ == '__main__':
-    main()
+    # Run the scraper without writing to the database.  Products print as they are parsed.
+    list(main())
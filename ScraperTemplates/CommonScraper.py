@@ -7,11 +7,52 @@
 """
 
 from bs4 import BeautifulSoup
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+import collections
+import email.utils
+import functools
+import hashlib
+import heapq
+import http.client
+import itertools
+import json
+import lxml.html
+import multiprocessing
+import os
+import random
+import re
+import socket
+import threading
+import time
+import urllib.error
+import urllib.parse
 import urllib.request
+import urllib.robotparser
+
+import ScraperMetrics as Metrics
 
 # Set scraper config
-MAX_ATTEMPTS = 3                # max number of urlib requests for each site before skipping
+MAX_ATTEMPTS = 3                # max number of urllib requests for each page before skipping it
+CONNECT_TIMEOUT = 10            # max time (seconds) to wait for a website to accept a connection
+READ_TIMEOUT = 30               # max time (seconds) to wait on each read of a page once connected
+BACKOFF_BASE = 1.0              # max wait (seconds) before the first retry, doubled for each later retry.  Jittered.
+BACKOFF_MAX = 30.0              # max wait (seconds) before any retry
+CIRCUIT_FAILURES = 5            # failed requests in a row before a website's circuit opens and its pages are skipped
+CIRCUIT_RESET = 300             # time (seconds) an open circuit waits before letting one trial request through
 MAX_AGE_BEFORE_DEACTIVATE = 14  # max time (days) since a product is last updated in the db before deactivating in our db.
+MAX_WORKERS = 8                 # max number of pages requested at once across all scrapers (global cap)
+MAX_WORKERS_PER_HOST = 4        # max number of pages requested at once from any one website
+RATE_LIMIT = 2.0                # max requests per second to a website, unless its template sets its own RATE_LIMIT
+RATE_BURST = MAX_WORKERS_PER_HOST  # requests a website may receive at once before RATE_LIMIT spacing applies
+MAX_RETRY_AFTER = 120           # max time (seconds) to hold a website's requests when it asks to wait (Retry-After)
+OBEY_ROBOTS_CRAWL_DELAY = True  # slow to the Crawl-delay/Request-rate in each website's robots.txt if it is lower
+PARSE_BACKEND = "soup"          # "soup" walks a BeautifulSoup tree.  "xpath" reads an lxml tree with each template's
+                                #   compiled XPath expressions, which is several times faster.  See ScraperBenchmark.py.
+PARSE_WORKERS = None            # processes parsing product pages (see fetch_products).  None for one per core but one,
+                                #   left for fetching and the database.  0 parses in each scraper's own thread.
+HTTP_CACHE_DIR = "http_cache"   # directory of cached pages for conditional requests.  None to always download in full.
+HTTP_CACHE_TTL = 7 * 24 * 3600  # max age (seconds) of a cached page before it is downloaded in full again
+HTTP_CACHE_MAX_BYTES = 500 * 1024 * 1024  # max size of the page cache.  Least recently used pages are removed first.
 
 
 class Product:
@@ -36,27 +77,908 @@ class Product:
             source=self.source
         )
 
+    def fingerprint(self):
+        """
+            Content hash of the fields written to the database (name, description, cost, image, URL and tea type).
+            Stored with the product so a later crawl can tell whether anything changed.
+        """
+        fields = [self.name, self.description, repr(self.cost), self.image, self.url, self.type]
+        content = "\x1f".join(str(field) for field in fields)
+        return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+class HttpCache:
+    """
+        On-disk cache of downloaded pages, used to make conditional requests.
+        Each page is stored as <key>.body with a <key>.json holding its URL and ETag/Last-Modified headers.  Later
+            requests for the page send If-None-Match/If-Modified-Since, and on "304 Not Modified" the stored body is
+            reused instead of downloading it again.
+        Pages without either header can't be revalidated and are not stored.  Entries downloaded in full more than ttl
+            ago are downloaded in full again, however often they were revalidated since.  When the cache grows past
+            max_bytes the least recently used (stored or revalidated) entries are removed.
+    """
+    def __init__(self, directory, ttl=HTTP_CACHE_TTL, max_bytes=HTTP_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._size = None
+        self._lock = threading.Lock()
+
+    def _path(self, url, extension):
+        key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, key + extension)
+
+    def _load(self, url):
+        """Return (metadata, body path) for a fresh entry, or (None, None)."""
+        body_path = self._path(url, ".body")
+        try:
+            with open(self._path(url, ".json")) as metadata_file:
+                metadata = json.load(metadata_file)
+        except (OSError, ValueError):
+            return None, None
+        # Entries written before "downloaded" was recorded fall back to their last use.
+        downloaded = metadata.get("downloaded", metadata.get("stored", 0))
+        if metadata.get("url") != url or time.time() - downloaded > self.ttl or not os.path.exists(body_path):
+            return None, None
+        return metadata, body_path
+
+    def fetch(self, url, open_url=urllib.request.urlopen):
+        """
+            Return the body of the page at url, revalidating a cached copy if there is one.
+            open_url(request) sends the request (ex. FetchPolicy.open).  Raises urllib errors like urllib.request.urlopen.
+        """
+        metadata, body_path = self._load(url)
+        request = urllib.request.Request(url)
+        if metadata:
+            if metadata.get("etag"):
+                request.add_header("If-None-Match", metadata["etag"])
+            if metadata.get("last_modified"):
+                request.add_header("If-Modified-Since", metadata["last_modified"])
+
+        try:
+            response = open_url(request)
+        except urllib.error.HTTPError as error:
+            if error.code != 304 or not metadata:
+                raise
+            # Not modified: reuse the stored body and mark the entry as recently used.
+            with open(body_path, "rb") as body_file:
+                body = body_file.read()
+            self._store_metadata(url, metadata)
+            return body
+
+        with response:
+            body = response.read()
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+        if etag or last_modified:
+            self._store(url, body, {"url": url, "etag": etag, "last_modified": last_modified, "downloaded": time.time()})
+        return body
+
+    def _store_metadata(self, url, metadata):
+        """Write the entry's metadata.  "stored" is its last use, for eviction; the TTL runs from "downloaded"."""
+        metadata["stored"] = time.time()
+        self._write(self._path(url, ".json"), json.dumps(metadata).encode("utf-8"))
+
+    def _store(self, url, body, metadata):
+        os.makedirs(self.directory, exist_ok=True)
+        body_path = self._path(url, ".body")
+        try:
+            replaced = os.path.getsize(body_path)
+        except OSError:
+            replaced = 0
+        self._write(body_path, body)
+        self._store_metadata(url, metadata)
+
+        with self._lock:
+            if self._size is None:
+                self._size = self._disk_size()
+            else:
+                self._size += len(body) - replaced
+            if self._size > self.max_bytes:
+                self._evict()
+
+    @staticmethod
+    def _write(path, data):
+        """Write through a temporary file so other threads and later runs never read a partial entry."""
+        temporary_path = "{path}.{thread}.tmp".format(path=path, thread=threading.get_ident())
+        with open(temporary_path, "wb") as output:
+            output.write(data)
+        os.replace(temporary_path, path)
+
+    def _disk_size(self):
+        return sum(entry.stat().st_size for entry in os.scandir(self.directory) if entry.name.endswith(".body"))
+
+    def _evict(self):
+        """Remove least recently used entries (oldest metadata) until the cache is back under three quarters full."""
+        entries = sorted(
+            (entry for entry in os.scandir(self.directory) if entry.name.endswith(".json")),
+            key=lambda entry: entry.stat().st_mtime
+            )
+        for entry in entries:
+            if self._size <= self.max_bytes * 3 // 4:
+                break
+            body_path = entry.path[:-len(".json")] + ".body"
+            try:
+                self._size -= os.path.getsize(body_path)
+                os.remove(body_path)
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+
+# Page cache shared by all scrapers.
+HTTP_CACHE = HttpCache(HTTP_CACHE_DIR) if HTTP_CACHE_DIR else None
+
+
+class FixtureReplay:
+    """
+        Serves saved pages in place of the websites, for benchmarks and offline runs (see ScraperBenchmark.py).
+        The fixture directory's manifest.json lists URL patterns (regular expressions) and the file saved for each.  The
+            file name and any "substitute" values are filled in from the pattern's groups, and substitutions are
+            replaced in the page, so one saved product page can stand in for many products.
+        latency adds a delay (seconds) to every page to simulate the round trip to a website.
+        URLs with no fixture raise a 404 HTTPError, as a missing page would.
+    """
+    def __init__(self, directory, latency=0.0):
+        self.directory = directory
+        self.latency = latency
+        with open(os.path.join(directory, "manifest.json")) as manifest_file:
+            manifest = json.load(manifest_file)
+        self.pages = [(re.compile(page["url"]), page["file"], page.get("substitute", {})) for page in manifest["pages"]]
+        self.requests = 0
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def _read(self, filename):
+        with self._lock:
+            if filename not in self._files:
+                with open(os.path.join(self.directory, filename), "rb") as fixture:
+                    self._files[filename] = fixture.read()
+            return self._files[filename]
+
+    def fetch(self, url):
+        """Return the saved page for url."""
+        for pattern, filename, substitute in self.pages:
+            match = pattern.fullmatch(url)
+            if match:
+                break
+        else:
+            raise urllib.error.HTTPError(url, 404, "No fixture for URL", {}, None)
+
+        with self._lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        groups = match.groups()
+        body = self._read(filename.format(*groups))
+        for old, new in substitute.items():
+            body = body.replace(old.encode("utf-8"), new.format(*groups).encode("utf-8"))
+        return body
+
+
+# Saved pages served instead of the websites when set (see FixtureReplay).
+REPLAY = None
+
+# Checkpoints of the current scraper run when set (a ScraperCrawlState.CrawlRun, set by Scraper.main).  Product pages
+# already handled by an earlier attempt at a resumed run are skipped, and each page's progress and errors are recorded.
+CRAWL = None
+
+
+class ReadTimeoutMixin:
+    """
+        http.client connection whose socket timeout changes to read_timeout once connected, so the urllib timeout only
+            bounds connecting.
+    """
+    def __init__(self, *args, read_timeout=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.read_timeout = read_timeout
+
+    def connect(self):
+        super().connect()
+        self.sock.settimeout(self.read_timeout)
+
+
+class ReadTimeoutHTTPConnection(ReadTimeoutMixin, http.client.HTTPConnection):
+    pass
+
+
+class ReadTimeoutHTTPSConnection(ReadTimeoutMixin, http.client.HTTPSConnection):
+    pass
+
+
+class ReadTimeoutHTTPHandler(urllib.request.HTTPHandler):
+    def __init__(self, read_timeout):
+        super().__init__()
+        self.read_timeout = read_timeout
+
+    def http_open(self, request):
+        return self.do_open(functools.partial(ReadTimeoutHTTPConnection, read_timeout=self.read_timeout), request)
+
+
+class ReadTimeoutHTTPSHandler(urllib.request.HTTPSHandler):
+    def __init__(self, read_timeout):
+        super().__init__()
+        self.read_timeout = read_timeout
+
+    def https_open(self, request):
+        # The SSL context carries the hostname check (HTTPSHandler's check_hostname was removed in Python 3.12).
+        return self.do_open(functools.partial(ReadTimeoutHTTPSConnection, read_timeout=self.read_timeout), request,
+                            context=self._context)
 
-def parse_page(url, parser, try_counter=0):
+
+class CircuitBreaker:
+    """
+        Failure tracker for one website.  After `failures` failed requests in a row the circuit opens and requests to the
+            website are refused without being sent.  After `reset` seconds one trial request is let through: success
+            closes the circuit, failure opens it again.
+    """
+    def __init__(self, failures=CIRCUIT_FAILURES, reset=CIRCUIT_RESET):
+        self.failures = failures
+        self.reset = reset
+        self.failed = 0
+        self.opened = None
+        self.trial = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """True if a request may be sent now."""
+        with self._lock:
+            if self.opened is None:
+                return True
+            if self.trial or time.monotonic() - self.opened < self.reset:
+                return False
+            self.trial = True
+            return True
+
+    def succeeded(self):
+        with self._lock:
+            self.failed = 0
+            self.opened = None
+            self.trial = False
+
+    def failed_request(self):
+        with self._lock:
+            self.failed += 1
+            if self.trial or self.failed >= self.failures:
+                self.opened = time.monotonic()
+                self.trial = False
+
+
+class FetchPolicy:
+    """
+        How pages are requested: connect and read timeouts, retries with jittered exponential backoff, and a circuit
+            breaker per website so a site that is down fails fast instead of tying up workers the other scrapers need.
+        Timeouts, 5xx responses and dropped connections are retried.  Other errors (ex. 404) are not.
+    """
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, max_attempts=MAX_ATTEMPTS,
+                 backoff_base=BACKOFF_BASE, backoff_max=BACKOFF_MAX, circuit_failures=CIRCUIT_FAILURES,
+                 circuit_reset=CIRCUIT_RESET):
+        self.connect_timeout = connect_timeout
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.circuit_failures = circuit_failures
+        self.circuit_reset = circuit_reset
+        self.opener = urllib.request.build_opener(ReadTimeoutHTTPHandler(read_timeout),
+                                                  ReadTimeoutHTTPSHandler(read_timeout))
+        self._circuits = {}
+        self._lock = threading.Lock()
+
+    def open(self, request):
+        """Send a request (URL or urllib.request.Request) with the policy's timeouts.  Returns the response."""
+        return self.opener.open(request, timeout=self.connect_timeout)
+
+    def circuit(self, url):
+        """Return the circuit breaker for the URL's host, creating it on first use."""
+        host = urllib.parse.urlsplit(url).netloc
+        with self._lock:
+            if host not in self._circuits:
+                self._circuits[host] = CircuitBreaker(self.circuit_failures, self.circuit_reset)
+            return self._circuits[host]
+
+    @staticmethod
+    def retryable(error):
+        """True for errors worth another attempt: timeouts, 5xx responses and dropped connections."""
+        if isinstance(error, urllib.error.HTTPError):
+            return error.code >= 500 or error.code in (408, 429)
+        if isinstance(error, urllib.error.URLError):
+            error = error.reason
+        return isinstance(error, (socket.timeout, ConnectionError, http.client.HTTPException))
+
+    @staticmethod
+    def host_failure(error):
+        """True if the error counts against the website's circuit (anything but a 4xx answer)."""
+        return not isinstance(error, urllib.error.HTTPError) or error.code >= 500
+
+    def backoff(self, retry):
+        """Seconds to wait before the given retry (1 for the first): random up to base * 2^(retry - 1), capped."""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (retry - 1)))
+
+
+# Policy used by parse_page unless another one is passed in.
+FETCH_POLICY = FetchPolicy()
+
+
+class TokenBucket:
+    """
+        Request schedule for one website: up to `burst` requests at once, then `rate` requests per second.
+        reserve() takes a token and returns how long the caller must wait before sending its request, so callers queue
+            in the order they reserved.  pause() holds every later request until the given time has passed.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token.  Returns the seconds to wait before sending the request."""
+        with self._lock:
+            now = time.monotonic()
+            if now > self.updated:
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+            self.tokens -= 1
+            wait_seconds = self.updated - now
+            if self.tokens < 0:
+                wait_seconds += -self.tokens / self.rate
+            return wait_seconds
+
+    def pause(self, seconds):
+        """Send nothing more for `seconds` (ex. a Retry-After header), then resume at `rate` without a burst."""
+        with self._lock:
+            self.updated = max(self.updated, time.monotonic() + seconds)
+            self.tokens = min(self.tokens, 0)
+
+    def slow_to(self, rate):
+        """Lower the rate (ex. to a robots.txt Crawl-delay), sending one request at a time."""
+        with self._lock:
+            self.rate = min(self.rate, rate)
+            self.burst = 1
+            self.tokens = min(self.tokens, 1)
+
+
+def robots_delay(site_url, policy=None):
+    """Seconds between requests asked for by the website's robots.txt (Crawl-delay or Request-rate), or None."""
+    robots = urllib.robotparser.RobotFileParser()
+    try:
+        with (policy or FETCH_POLICY).open(site_url + "/robots.txt") as response:
+            robots.parse(response.read().decode("utf-8", "replace").splitlines())
+    except (OSError, http.client.HTTPException, ValueError):
+        return None
+
+    delay = robots.crawl_delay("*")
+    request_rate = robots.request_rate("*")
+    if request_rate and request_rate.requests:
+        delay = max(delay or 0, request_rate.seconds / request_rate.requests)
+    return float(delay) if delay else None
+
+
+class RateLimiter:
+    """
+        Token bucket per website, so the crawl stays under what each vendor tolerates.
+        Websites default to RATE_LIMIT requests per second.  Templates set their own with set_rate_limit().  The first
+            request to a website reads its robots.txt and slows to its crawl delay if that is lower.
+    """
+    def __init__(self, rate=RATE_LIMIT, burst=RATE_BURST, obey_robots=OBEY_ROBOTS_CRAWL_DELAY):
+        self.rate = rate
+        self.burst = burst
+        self.obey_robots = obey_robots
+        self._limits = {}
+        self._buckets = {}
+        self._host_locks = {}
+        self._lock = threading.Lock()
+
+    def configure(self, url, rate, burst=None):
+        """Set the request rate (per second) for the URL's website."""
+        host = urllib.parse.urlsplit(url).netloc
+        with self._lock:
+            self._limits[host] = (rate, burst or self.burst)
+            self._buckets.pop(host, None)
+
+    def bucket(self, url):
+        """
+            Return the token bucket for the URL's website, creating it (and reading robots.txt) on first use.
+            The bucket is only shared once its rate is final.  Other requests to the website wait on the host's lock
+                while robots.txt is read, so none of them goes out faster than the crawl delay; other websites don't.
+        """
+        parts = urllib.parse.urlsplit(url)
+        with self._lock:
+            bucket = self._buckets.get(parts.netloc)
+            if bucket:
+                return bucket
+            host_lock = self._host_locks.setdefault(parts.netloc, threading.Lock())
+
+        with host_lock:
+            with self._lock:
+                bucket = self._buckets.get(parts.netloc)
+                if bucket:
+                    return bucket
+                rate, burst = self._limits.get(parts.netloc, (self.rate, self.burst))
+
+            bucket = TokenBucket(rate, burst)
+            if self.obey_robots:
+                delay = robots_delay("{scheme}://{host}".format(scheme=parts.scheme, host=parts.netloc))
+                if delay:
+                    bucket.slow_to(1 / delay)
+            with self._lock:
+                self._buckets[parts.netloc] = bucket
+        return bucket
+
+    def reserve(self, url):
+        """Take a request slot for the URL's website.  Returns the seconds to wait before sending the request."""
+        return self.bucket(url).reserve()
+
+    def pause(self, url, seconds):
+        self.bucket(url).pause(seconds)
+
+
+# Rate limits shared by all scrapers.  None turns rate limiting off.
+RATE_LIMITER = RateLimiter()
+
+
+def set_rate_limit(url, rate, burst=None):
+    """Set the request rate (per second) for a template's website.  Called by the templates next to their URLs."""
+    RATE_LIMITER.configure(url, rate, burst)
+
+
+def schedule_request(url):
+    """Reserve a request to the URL's website.  Returns the seconds to wait first.  Saved pages (REPLAY) never wait."""
+    if REPLAY or not RATE_LIMITER:
+        return 0.0
+    return RATE_LIMITER.reserve(url)
+
+
+def retry_after(error):
+    """Seconds a 429/503 response asks the client to wait (its Retry-After header), or None."""
+    value = error.headers.get("Retry-After") if isinstance(error, urllib.error.HTTPError) and error.headers else None
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        retry_date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_date.timestamp() - time.time())
+
+
+def download(url, policy=None):
+    """Return the body of the page at url, through the page cache when it is enabled."""
+    policy = policy or FETCH_POLICY
+    if REPLAY:
+        return REPLAY.fetch(url)
+    if HTTP_CACHE:
+        return HTTP_CACHE.fetch(url, policy.open)
+    with policy.open(url) as response:
+        return response.read()
+
+
+def skip_page(url, reason):
+    """Report a page given up on, recording why in the run's checkpoints."""
+    print("Skipping {url}: {reason}".format(url=url, reason=reason))
+    if CRAWL:
+        CRAWL.failed(url, reason)
+
+
+class ListingError(Exception):
+    """
+        Raised by a scraper, after yielding the products it could read, when part of its product list could not be
+            retrieved.  The products missing from the list may still be for sale, so Scraper.main() records the scraper as
+            failed and doesn't deactivate its source's products for the run.
+    """
+
+
+class RetryLater(collections.namedtuple("RetryLater", ["wait_seconds", "retry"])):
+    """
+        Returned by a fetch engine task that has to wait before trying again (see fetch_html's defer_retries).  The
+            engine frees the task's worker and host slot, and calls retry() on the pool once wait_seconds have passed.
+    """
+    def then(self, finish):
+        """The same retry, with finish(result) applied to the result it eventually gives."""
+        return RetryLater(self.wait_seconds, lambda: after(self.retry(), finish))
+
+
+def after(result, finish):
+    """finish(result), or once a RetryLater result has been retried."""
+    if isinstance(result, RetryLater):
+        return result.then(finish)
+    return finish(result)
+
+
+def fetch_html(url, policy=None, scheduled=False, defer_retries=False, attempt=1):
+    """
+        Download the page at url under the fetch policy (see FetchPolicy), retrying with backoff as needed.  Every
+            request waits its turn under the website's rate limit (see RateLimiter), except a first request the fetch
+            engine has already scheduled (scheduled=True).
+        Requests run on the fetch engine pass defer_retries=True: instead of sleeping through the backoff (or a
+            website's Retry-After) a RetryLater is returned, so the worker and the website's slot are free in the
+            meantime and the engine sends the retry when it is due.
+        Returns the page body, or None if it could not be retrieved or the website's circuit is open.
+    """
+    policy = policy or FETCH_POLICY
+    circuit = policy.circuit(url)
+    wait_seconds = 0.0 if scheduled else schedule_request(url)
+    for attempt in range(attempt, policy.max_attempts + 1):
+        time.sleep(wait_seconds)
+        if not circuit.allow():
+            skip_page(url, "too many failed requests to the website")
+            Metrics.METRICS.count_skipped(url)
+            return None
+
+        start = time.perf_counter()
+        try:
+            html = download(url, policy)
+        except (OSError, http.client.HTTPException) as error:
+            Metrics.METRICS.observe_fetch(url, time.perf_counter() - start, ok=False)
+            if policy.host_failure(error):
+                circuit.failed_request()
+            else:
+                circuit.succeeded()
+            if not policy.retryable(error) or attempt == policy.max_attempts:
+                skip_page(url, error)
+                return None
+            Metrics.METRICS.count_retry(url)
+
+            # Honor the website's Retry-After for all of its requests, and wait at least the backoff for this one.
+            requested_wait = retry_after(error)
+            if requested_wait is not None and RATE_LIMITER:
+                RATE_LIMITER.pause(url, min(requested_wait, MAX_RETRY_AFTER))
+            wait_seconds = max(policy.backoff(attempt), schedule_request(url))
+            if defer_retries:
+                return RetryLater(wait_seconds, functools.partial(
+                    fetch_html, url, policy, scheduled=True, defer_retries=True, attempt=attempt + 1))
+            continue
+        except Exception as error:
+            # Anything else (ex. a malformed URL) skips this page without ending the crawl.
+            Metrics.METRICS.observe_fetch(url, time.perf_counter() - start, ok=False)
+            skip_page(url, error)
+            return None
+
+        Metrics.METRICS.observe_fetch(url, time.perf_counter() - start)
+        circuit.succeeded()
+        return html
+
+
+SOUP_BACKEND = "soup"
+XPATH_BACKEND = "xpath"
+
+
+def make_page(html, parser):
+    """
+        Parse downloaded HTML.  parser is a bs4 parser name ("lxml", "html.parser", ...) for a BeautifulSoup object, or
+            XPATH_BACKEND for a native lxml tree.
+    """
+    if parser == XPATH_BACKEND:
+        return lxml.html.document_fromstring(html)
+    return BeautifulSoup(html, parser)
+
+
+def page_parser(parser):
+    """Parser to request pages with under the configured PARSE_BACKEND: the template's bs4 parser or XPATH_BACKEND."""
+    return XPATH_BACKEND if PARSE_BACKEND == XPATH_BACKEND else parser
+
+
+def has_class(name):
+    """XPath condition matching elements with the CSS class name, as bs4's class_="name" does."""
+    return "contains(concat(' ', normalize-space(@class), ' '), ' {name} ')".format(name=name)
+
+
+def element_string(element):
+    """lxml equivalent of bs4's Tag.string: the element's text when it is the element's only content, else None."""
+    if element is None:
+        return None
+    children = list(element)
+    if not children:
+        return element.text
+    if len(children) == 1 and not element.text and not children[0].tail:
+        return element_string(children[0])
+    return None
+
+
+def missing_detail(**details):
+    """Name of the first empty product detail passed in, ex. "cost", or None if every detail has a value."""
+    for name, value in details.items():
+        if not value:
+            return name
+    return None
+
+
+def first(elements):
+    """First result of an XPath expression, or None."""
+    return elements[0] if elements else None
+
+
+def parse_page(url, parser, policy=None, scheduled=False, defer_retries=False):
     """
         Convert a website by URL into a BeautifulSoup parser object.
         params: 
             'url': URL of website to parse
-            'parser': parser interpretter.  ex. "HTML", "LXML", "XML".  See bs4 documentation.
-            'try_counter': number of attempts already to access URL already.  Will skip URL after attempting a
-                max number of times set by config variable MAX_ATTEMPTS.
+            'parser': parser interpretter.  ex. "HTML", "LXML", "XML".  See bs4 documentation.  XPATH_BACKEND returns an
+                lxml tree instead (see make_page).
+            'policy': FetchPolicy for timeouts, retries and the circuit breaker.  Defaults to FETCH_POLICY.  The page is
+                skipped (False returned) after MAX_ATTEMPTS failed requests.
+            'scheduled': True if the request was already scheduled under the website's rate limit (see fetch_pages).
+            'defer_retries': True on the fetch engine, to return a RetryLater instead of waiting to retry (see
+                fetch_html).
     """
-    html = None
-    if try_counter <= MAX_ATTEMPTS:
-        # Attempt to access URL.  If not, recursively call until try_counter > MAX_ATTEMPTS.
+    def parse(html):
+        if not html:
+            return False
+        
+        start = time.perf_counter()
+        page = make_page(html, parser)
+        Metrics.METRICS.observe_parse(url, time.perf_counter() - start)
+        return page
+    
+    return after(fetch_html(url, policy, scheduled, defer_retries), parse)
+
+
+class FetchEngine:
+    """
+        Shared worker pool used by every scraper template to request pages concurrently.
+        The pool size is the global cap on requests in flight.  Each host is additionally limited by its own semaphore
+            so that one large website cannot take every worker away from the other scrapers.
+        Rate limits are waited out in map(), in the calling scraper's thread, before a request is handed to the pool.
+            Retries are too: a task returning RetryLater gives back its worker and host slot, and map() runs the retry
+            once it is due.  Workers are never held by a slow or throttled website's schedule, so each website's pages
+            go out at its own pace and the crawl takes about as long as the slowest website rather than the sum of all
+            of them.
+    """
+    # Poll interval (seconds) while a due retry waits for a host slot held by another scraper's requests.
+    RETRY_POLL = 0.05
+
+    def __init__(self, max_workers=MAX_WORKERS, max_workers_per_host=MAX_WORKERS_PER_HOST):
+        self.max_workers = max_workers
+        self.max_workers_per_host = max_workers_per_host
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._host_limits = {}
+        self._lock = threading.Lock()
+
+    def host_limit(self, url):
+        """Return the semaphore limiting concurrent requests to the URL's host, creating it on first use."""
+        host = urllib.parse.urlsplit(url).netloc
+        with self._lock:
+            if host not in self._host_limits:
+                self._host_limits[host] = threading.BoundedSemaphore(self.max_workers_per_host)
+            return self._host_limits[host]
+
+    def map(self, func, urls, schedule=None):
+        """
+            Call func(url) on the worker pool for each URL and yield (url, result) pairs in the order they complete.
+            URLs are read lazily, so a generator can keep feeding URLs to the engine while pages are still downloading.
+            schedule(url), if given, returns the seconds to wait before the URL may be requested (ex. schedule_request).
+            func may return a RetryLater, in which case its retry is run later in the same way and its eventual result
+                is the one yielded.
+        """
+        pending = {}
+        retries = []    # heap of (due time, order, url, retry) for tasks waiting to try again
+        order = itertools.count()
+        for url in urls:
+            limit = self.host_limit(url)
+
+            # Wait for a free slot on this host.  Hand back any finished pages while waiting so they can be parsed.
+            while not limit.acquire(blocking=False):
+                if not pending and not retries:
+                    limit.acquire()
+                    break
+                yield from self._collect(pending, retries, order)
+
+            # Wait for the host's next request slot, again handing back finished pages meanwhile.
+            ready = time.monotonic() + (schedule(url) if schedule else 0.0)
+            while time.monotonic() < ready:
+                yield from self._collect(pending, retries, order, timeout=ready - time.monotonic())
+
+            pending[self._executor.submit(self._run, func, url, limit)] = url
+
+        # Drain the remaining requests and retries as they finish.
+        while pending or retries:
+            yield from self._collect(pending, retries, order)
+
+    def _collect(self, pending, retries, order, timeout=None):
+        """
+            Start the retries that are due, then wait up to timeout for running tasks (or the next retry to fall due).
+            Yields (url, result) for each finished task.  Tasks returning RetryLater are queued on retries instead.
+        """
+        now = time.monotonic()
+        blocked = []
+        while retries and retries[0][0] <= now:
+            entry = heapq.heappop(retries)
+            limit = self.host_limit(entry[2])
+            if limit.acquire(blocking=False):
+                pending[self._executor.submit(self._run, entry[3], entry[2], limit, retry=True)] = entry[2]
+            else:
+                blocked.append(entry)
+        for entry in blocked:
+            heapq.heappush(retries, entry)
+
+        waits = [timeout] if timeout is not None else []
+        if retries:
+            waits.append(self.RETRY_POLL if blocked else retries[0][0] - now)
+        timeout = max(0.0, min(waits)) if waits else None
+        if not pending:
+            time.sleep(timeout or 0.0)
+            return
+        done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            url = pending.pop(future)
+            result = future.result()
+            if isinstance(result, RetryLater):
+                heapq.heappush(retries, (time.monotonic() + result.wait_seconds, next(order), url, result.retry))
+            else:
+                yield url, result
+
+    @staticmethod
+    def _run(func, url, limit, retry=False):
+        """Worker task (func(url), or func() for a retry).  Always give the host slot back, even if the request fails."""
         try:
-            html = urllib.request.urlopen(url)
-        except urllib.error.HTTPError:
-            parse_page(url, parser, try_counter + 1)
+            return func() if retry else func(url)
+        finally:
+            limit.release()
 
-    if not html:
-        return False
-    return BeautifulSoup(html, parser)
+
+# Single engine shared by all scrapers so the global cap applies to the whole crawl.
+ENGINE = FetchEngine()
+
+
+def fetch_pages(urls, parser):
+    """
+        Parse many URLs concurrently through the shared fetch engine.
+        Yields (url, soup) pairs as each page arrives.  soup is False if the page could not be retrieved (see parse_page).
+    """
+    return ENGINE.map(lambda url: parse_page(url, parser, scheduled=True, defer_retries=True), urls,
+                      schedule=schedule_request)
+
+
+# Result of reading a product page in the parse pool.  fields are the Product's attributes (None if the page had no
+# usable product) and rejected the reject counts recorded while reading it, as in RunMetrics.rejected.
+ParsedPage = collections.namedtuple("ParsedPage", ["fields", "rejected", "parse_seconds", "extract_seconds"])
+
+
+def read_product(url, html, parser, parse, args=()):
+    """Parse a downloaded page and read its product with parse(url, page, *args).  Returns (product, parse, extract time)."""
+    start = time.perf_counter()
+    page = make_page(html, parser)
+    parse_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    product = parse(url, page, *args)
+    return product, parse_seconds, time.perf_counter() - start
+
+
+def read_product_in_worker(url, html, parser, parse, args=()):
+    """
+        Parse pool task: read_product() in a worker process.  Returns a ParsedPage of plain values, since Products and
+            parsed trees are not sent between processes.
+        Rejects recorded by the template (make_product) go to this process's own RunMetrics and are sent back with the
+            result, so the scraper process can count them.
+    """
+    metrics = Metrics.start_run()
+    product, parse_seconds, extract_seconds = read_product(url, html, parser, parse, args)
+    return ParsedPage(vars(product) if product else None, metrics.rejected, parse_seconds, extract_seconds)
+
+
+def parse_worker_count():
+    """Number of parse processes for PARSE_WORKERS (None means one per core but one)."""
+    if PARSE_WORKERS is None:
+        return max(0, (os.cpu_count() or 1) - 1)
+    return PARSE_WORKERS
+
+
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+
+def parse_pool():
+    """
+        Process pool shared by all scrapers for parsing product pages, started on first use.  None when parsing in-thread.
+        Workers are spawned rather than forked, since forking a process with fetch threads running is unsafe.
+    """
+    global _parse_pool
+    workers = parse_worker_count()
+    if not workers:
+        return None
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            _parse_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        return _parse_pool
+
+
+def shutdown_parse_pool():
+    """Stop the parse pool's workers and wait for them to exit.  The next parse_pool() call starts a new pool."""
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is not None:
+            _parse_pool.shutdown()
+            _parse_pool = None
+
+
+def fetch_products(urls, parse, parser, source, product_args=None):
+    """
+        Fetch product pages through the shared fetch engine and read a product from each with parse(url, page, *args),
+            where args is product_args(url) (ex. the product's collection), or nothing.  parse must be a module-level
+            function so it can be sent to the parse pool.
+        Fetching and parsing are separate stages: the engine's threads only download, and pages are parsed in the parse
+            pool (PARSE_WORKERS processes) as they arrive, so BeautifulSoup's tree building runs on every core instead of
+            holding the GIL against the fetch threads.  With no parse pool, pages are parsed in the calling thread.
+        Yields (url, Product or None) as each page is read.  Pages that could not be downloaded are skipped.  Parse time,
+            extraction time and rejects are recorded in the run's metrics.
+        An error on one page (ex. a template failing on an unexpected layout) skips that page only: it is counted as a
+            "parse_error" reject and recorded in the run's checkpoints (CRAWL), and the other pages carry on.  With CRAWL
+            set, pages an earlier attempt at the run already handled are not fetched again.
+    """
+    def fetched(url, html):
+        if html and CRAWL:
+            CRAWL.fetched(url)
+        return html
+
+    def fetch(url):
+        return after(fetch_html(url, scheduled=True, defer_retries=True), functools.partial(fetched, url))
+
+    if CRAWL:
+        urls = CRAWL.pending(urls)
+    pages = ((url, html) for url, html in ENGINE.map(fetch, urls, schedule=schedule_request) if html)
+    pool = parse_pool()
+
+    def failed(url, error):
+        Metrics.METRICS.reject(source, "parse_error")
+        skip_page(url, "{name}: {error}".format(name=type(error).__name__, error=error))
+        return url, None
+
+    def checkpoint(url, product):
+        if CRAWL:
+            if product:
+                CRAWL.parsed(url)
+            else:
+                CRAWL.rejected(url)
+        return url, product
+
+    if pool is None:
+        for url, html in pages:
+            try:
+                product, parse_seconds, extract_seconds = read_product(
+                    url, html, parser, parse, product_args(url) if product_args else ())
+            except Exception as error:
+                yield failed(url, error)
+                continue
+            Metrics.METRICS.observe_parse(url, parse_seconds)
+            Metrics.METRICS.observe_extract(source, extract_seconds)
+            yield checkpoint(url, product)
+        return
+
+    def result(url, future):
+        try:
+            parsed = future.result()
+        except Exception as error:
+            return failed(url, error)
+        Metrics.METRICS.observe_parse(url, parsed.parse_seconds)
+        Metrics.METRICS.observe_extract(source, parsed.extract_seconds)
+        for rejected_source, reasons in parsed.rejected.items():
+            for reason, count in reasons.items():
+                for _ in range(count):
+                    Metrics.METRICS.reject(rejected_source, reason)
+        return checkpoint(url, Product(**parsed.fields) if parsed.fields else None)
+
+    # Keep at most two pages per worker waiting to be parsed, so downloaded pages don't pile up in memory.
+    max_pending = 2 * parse_worker_count()
+    pending = {}
+    for url, html in pages:
+        args = product_args(url) if product_args else ()
+        pending[pool.submit(read_product_in_worker, url, html, parser, parse, args)] = url
+
+        # Hand back finished products without waiting, or wait for one if the pool is full.
+        done = [future for future in pending if future.done()]
+        if not done and len(pending) >= max_pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield result(pending.pop(future), future)
+
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield result(pending.pop(future), future)
 
 
 def grams_to_oz(weight):
@@ -12,13 +12,19 @@
 """
 
 import re
+import urllib.parse
 
-from ScraperTemplates.CommonScraper import Product, parse_page
+import lxml.etree
+
+import ScraperMetrics as Metrics
+from ScraperTemplates.CommonScraper import Product, parse_page, fetch_pages, fetch_products, page_parser, has_class, \
+    element_string, first, missing_detail, set_rate_limit, ListingError
 
 # set config
 MAIN_URL = "https://www.teasource.com/pages/tea-collection"
 BASE_URL = "https://www.teasource.com"
 COLLECTION_URL_SUFFIX = "?view=all"
+RATE_LIMIT = 4                  # max requests per second to the website (see CommonScraper.RateLimiter)
 TEA_TITLE_SPLITTER = " | "
 PARSER = "lxml"
 SOURCE = "TeaSource"
@@ -30,6 +36,17 @@ TEA_TYPE_MAP = {
     "Oolong Tea": "Oolong Tea"
     }
 
+set_rate_limit(BASE_URL, RATE_LIMIT)
+
+# Product page XPath expressions for the "xpath" parse backend (see parse_product_tree).  Compiled once per run.
+PRODUCT_XPATH = {
+    "title": lxml.etree.XPath("//title"),
+    "description": lxml.etree.XPath("//div[{cls}]".format(cls=has_class("product-description-wrapper"))),
+    "paragraphs": lxml.etree.XPath(".//p"),
+    "image": lxml.etree.XPath("(//div[{cls}])[1]//img/@src".format(cls=has_class("featured-image-div"))),
+    "variant": lxml.etree.XPath("(//div[@id='product-variants'])[1]//option")
+    }
+
 
 class Collection:
     def __init__(self, tea_type, link):
@@ -68,19 +85,14 @@ def get_tea_collection_urls(url):
     return lookup_collections
 
 
-def get_product_urls(url):
-    """Get a list of product URLs for each collection url passed"""
+def parse_product_urls(soup):
+    """Return the product URLs in every product grid of a collection page."""
     
-    # Parse the current product list page.  If no page retrieved or if parser changes, return no URLs.
-    soup = parse_page(url, PARSER)
-    if not soup:
-        return False
-
     # Find each products "product grid" containing its details.  Find each product within each grid.
+    product_list = []
     product_grids = soup.find_all(class_=re.compile("product-grid"))
     for grid in product_grids:
         products_html = grid.find_all(class_="indiv-product")
-        product_list = []
         for product in products_html:
             
             # Parse out the URL of any product in the product gris:
@@ -89,88 +101,173 @@ def get_product_urls(url):
     return product_list
 
 
+def get_product_urls(url):
+    """Get a list of product URLs for each collection url passed"""
+    
+    # Parse the current product list page.  If no page retrieved or if parser changes, return no URLs.
+    soup = parse_page(url, PARSER)
+    if not soup:
+        return False
+    return parse_product_urls(soup)
+
+
+def get_collections_product_urls(collections, missing=None):
+    """
+        Get the product URLs of every collection, with the collection pages fetched concurrently.
+        Returns {tea type: product URLs} in the website's collection order, so a product listed under several collections
+            always gets the tea type of the first one.
+        Collection pages that could not be retrieved are skipped, and their links added to the missing list if given.
+    """
+    pages = dict(fetch_pages([coll.link for coll in collections], PARSER))
+    url_list = {}
+    for coll in collections:
+        soup = pages.get(coll.link)
+        if soup:
+            url_list.setdefault(coll.tea_type, []).extend(parse_product_urls(soup))
+        elif missing is not None:
+            missing.append(coll.link)
+    return url_list
+
+
+def product_handle(url):
+    """The product's name in its URL (the path after /products/), the same under every collection it is listed in."""
+    return urllib.parse.urlsplit(url).path.rsplit("/products/", 1)[-1]
+
+
 def get_products(product_links):
-    """From a list of product URLs, pull details of the products."""
-    products = []
+    """From a list of product URLs, pull details of the products.  Yields each Product as soon as its page is parsed."""
+    
+    # Map each product URL back to the collection (tea type) it was listed under so the pages can be fetched together.
+    # A product listed in several collections has a URL under each, so products are matched by handle and the page is
+    # only fetched once, under the first collection.
+    collection_by_link = {}
+    handles = set()
     for collection, links in product_links.items():
         for link in links:
+            if product_handle(link) not in handles:
+                handles.add(product_handle(link))
+                collection_by_link[link] = collection
+    
+    parser = page_parser(PARSER)
+    parse = parse_product_tree if parser != PARSER else parse_product
+    for link, product in fetch_products(collection_by_link.keys(), parse, parser, SOURCE,
+                                        product_args=lambda link: (collection_by_link[link],)):
+        if product:
+            Metrics.METRICS.accept(SOURCE)
             
-            # Parse the current product list page.  If no page retrieved or if parser changes, skip this URL.
-            soup = parse_page(link, PARSER)
-            if not soup:
-                break
-
-            # Parse out the title.  It contains both the title and tea type, so parse out just the title from the string.
-            title = None
-            if TEA_TITLE_SPLITTER in soup.find("title").string:
-                title = soup.find("title").string.split(TEA_TITLE_SPLITTER)[0]
-
-            # Parse the descriptions.  String together all pararaphs of the description.
-            description_html = soup.find("div", class_="product-description-wrapper")
-            description = description_html.string
-            if not description:
-                desc_paragraphs = [para.string.strip() for para in description_html.find_all("p") if para.string is not None]
-                if desc_paragraphs and len(desc_paragraphs) > 0:
-                    description = " ".join(desc_paragraphs)
-            
-            
-            # Parse out the product image.  If the div tag contains an img tag, we can pull the img tag and the source URL.
-            def image_tag(tag):
-                """
-                    Return True if a given HTML tag is an image tag.
-                    bs4 documentation: https://www.crummy.com/software/BeautifulSoup/bs4/doc/#a-function
-                """
-                return tag.hasattr("img")
-            image_html = soup.find("div", image_tag, class_="featured-image-div")
-            image_url = image_html.find("img")
-            if image_url:
-                image_url = image_url["src"]
+            # Print for status updates as scraper runs.
+            print(product)
+            yield product
 
-            
-            # Parse out the item cost from the cost dropdown on the page.  Take the first cost option (assuming it is the
-            # most expensive unit cost).  Assume the first in the cost dropdown is the smallest size you can purchase.
-            cost = None
-            product_variants = soup.find("div", id="product-variants")
-            if not product_variants:
-                continue
-            first_product_variant = product_variants.find("option")
-            if not first_product_variant.string or not first_product_variant["value"]:
-                continue
-            cost_string = first_product_variant.string
-            id = first_product_variant["value"]
-            
-            # If a cost tag has found a potential product variant and cost, parse out the $ cost per the below regex.
-            cost_reg_match = re.match(r'(\d+) ounces - \$ (\d+).(\d+)', cost_string)
-            if cost_reg_match:
-                dollar_cost = int(cost_reg_match.group(2)) + (float(cost_reg_match.group(3)) / 100)
-                unit = int(cost_reg_match.group(1))
-                cost = dollar_cost / unit
-
-
-            # If all details are pulled, store the product.  Image is optional.
-            if title and description and cost and id:
-                products.append(Product(
-                    name=title,
-                    type=collection,
-                    description=description,
-                    cost=cost,
-                    source=SOURCE,
-                    id=id,
-                    url=link,
-                    image=image_url))
-            
-                # Print for status updates as scraper runs.
-                print(products[-1])
-            
-    return products
+
+def make_product(url, collection, title, description, cost_string, id, image_url):
+    """Clean up the raw values read from a product page and return a Product, or None if details are missing."""
+    
+    # The title contains both the title and tea type, so parse out just the title from the string.
+    if title and TEA_TITLE_SPLITTER in title:
+        title = title.split(TEA_TITLE_SPLITTER)[0]
+    else:
+        title = None
+    
+    # If a cost tag has found a potential product variant and cost, parse out the $ cost per the below regex.
+    cost = None
+    cost_reg_match = re.match(r'(\d+) ounces - \$ (\d+).(\d+)', cost_string) if cost_string else None
+    if cost_reg_match:
+        dollar_cost = int(cost_reg_match.group(2)) + (float(cost_reg_match.group(3)) / 100)
+        unit = int(cost_reg_match.group(1))
+        cost = dollar_cost / unit
+    
+    # If all details are pulled, store the product.  Image is optional.  Otherwise record why it was skipped.
+    missing = missing_detail(name=title, description=description, cost=cost, id=id)
+    if missing:
+        Metrics.METRICS.reject(SOURCE, "missing_" + missing)
+        return None
+    return Product(
+        name=title,
+        type=collection,
+        description=description,
+        cost=cost,
+        source=SOURCE,
+        id=id,
+        url=url,
+        image=image_url)
+
+
+def parse_product(url, soup, collection):
+    """
+        Read a product listed under collection (tea type) from its page's BeautifulSoup tree.
+        Returns a Product, or None if details are missing.
+    """
+    
+    # Parse out the title.
+    title = soup.find("title").string
+
+    # Parse the descriptions.  String together all pararaphs of the description.
+    description_html = soup.find("div", class_="product-description-wrapper")
+    description = description_html.string if description_html else None
+    if not description and description_html:
+        desc_paragraphs = [para.string.strip() for para in description_html.find_all("p") if para.string is not None]
+        if desc_paragraphs and len(desc_paragraphs) > 0:
+            description = " ".join(desc_paragraphs)
+    
+    # Parse out the product image.  If the div tag contains an img tag, we can pull the img tag and the source URL.
+    image_url = None
+    image_html = soup.find("div", class_="featured-image-div")
+    if image_html:
+        image_url = image_html.find("img")
+        if image_url:
+            image_url = image_url["src"]
+    
+    # Parse out the item cost from the cost dropdown on the page.  Take the first cost option (assuming it is the
+    # most expensive unit cost).  Assume the first in the cost dropdown is the smallest size you can purchase.
+    cost_string = id = None
+    product_variants = soup.find("div", id="product-variants")
+    first_product_variant = product_variants.find("option") if product_variants else None
+    if first_product_variant:
+        cost_string = first_product_variant.string
+        id = first_product_variant.get("value")
+    
+    return make_product(url, collection, title, description, cost_string, id, image_url)
+
+
+def parse_product_tree(url, tree, collection):
+    """
+        Read a product from its page's lxml tree with the PRODUCT_XPATH expressions (the "xpath" parse backend).
+        Reads the same elements as parse_product.  Returns a Product, or None if details are missing.
+    """
+    description_html = first(PRODUCT_XPATH["description"](tree))
+    description = element_string(description_html)
+    if not description and description_html is not None:
+        desc_paragraphs = [string.strip() for string in map(element_string, PRODUCT_XPATH["paragraphs"](description_html))
+                           if string is not None]
+        if desc_paragraphs:
+            description = " ".join(desc_paragraphs)
+    
+    cost_string = id = None
+    first_product_variant = first(PRODUCT_XPATH["variant"](tree))
+    if first_product_variant is not None:
+        cost_string = element_string(first_product_variant)
+        id = first_product_variant.get("value")
+    
+    image_url = first(PRODUCT_XPATH["image"](tree))
+    return make_product(url, collection, element_string(first(PRODUCT_XPATH["title"](tree))), description, cost_string,
+                        id, image_url)
 
 
 def main():
+    """
+        Yield every available product from TeaSource.
+        Raises ListingError once the products are read if the collection list, or any collection, couldn't be retrieved.
+    """
     # Pull a distinct list of product URLs and parse it for product details.
-    url_list = {}
-    for coll in get_tea_collection_urls(MAIN_URL):
-        url_list[coll.tea_type] = get_product_urls(coll.link)
-    return get_products(url_list)
+    collections = get_tea_collection_urls(MAIN_URL)
+    if not collections:
+        raise ListingError("could not read the collection list at {url}".format(url=MAIN_URL))
+    missing = []
+    yield from get_products(get_collections_product_urls(collections, missing))
+    if missing:
+        raise ListingError("could not read {count} collection pages: {urls}".format(
+            count=len(missing), urls=", ".join(missing)))
 
 
 def _test():
@@ -190,9 +287,10 @@ def _test():
     print("")
 
     # url_list = {"Green Tea": ["https://www.teasource.com/collections/green-tea/products/clouds-and-mist-supreme-green-tea"]}
-    get_products(url_list)
+    list(get_products(url_list))
 
 
 if __name__ == '__main__':
-    main()
+    # Run the scraper without writing to the database.  Products print as they are parsed.
+    list(main())
     # _test()
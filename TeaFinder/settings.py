@@ -41,6 +41,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'teas.middleware.PerformanceMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -74,14 +75,61 @@ WSGI_APPLICATION = 'TeaFinder.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/1.10/ref/settings/#databases
 
+# TEAFINDER_DB points the app at another copy of the database (ex. ScraperBenchmark.py migrating its working copy).
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'teas.db'),
+        'NAME': os.environ.get('TEAFINDER_DB', os.path.join(BASE_DIR, 'teas.db')),
     }
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/1.10/topics/cache/
+# Tea lists and menus are cached until the scraper rewrites CATALOG_VERSION_FILE after rebuilding the catalog.
+# Local memory is per process; use django.core.cache.backends.filebased.FileBasedCache to share the cache between
+#   server processes.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'teafinder',
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000,
+        },
+    }
+}
+
+CATALOG_VERSION_FILE = os.path.join(BASE_DIR, 'catalog.version')
+CATALOG_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+# Request performance (see teas/middleware.py)
+# Server-Timing headers show each request's view, SQL and render time in the browser's developer tools.  Requests
+#   slower than SLOW_REQUEST_MS are logged as warnings to the "teas.performance" logger, along with per URL name
+#   totals every PERFORMANCE_SUMMARY_EVERY requests.
+
+PERFORMANCE_SERVER_TIMING = True
+SLOW_REQUEST_MS = 500
+PERFORMANCE_SUMMARY_EVERY = 100
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'teas.performance': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/1.10/ref/settings/#auth-password-validators
 
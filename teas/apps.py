@@ -8,7 +8,19 @@
 """
 
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+
+import teas.helpers.DatabaseFunctions as Database
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    """Apply the shared sqlite connection profile (see helpers/DatabaseFunctions) to each new database connection."""
+    if connection.vendor == "sqlite":
+        Database.apply_profile(connection.connection)
 
 
 class TeasConfig(AppConfig):
     name = 'teas'
+
+    def ready(self):
+        connection_created.connect(configure_sqlite, dispatch_uid="teas.configure_sqlite")
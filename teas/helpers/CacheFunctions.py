@@ -0,0 +1,83 @@
+"""
+    CacheFunctions.py
+    Purpose: cache rendered catalog pages and menus between scraper runs.
+
+    The catalog only changes when Scraper.py runs.  Whenever a run leaves the catalog version file
+        (settings.CATALOG_VERSION_FILE) behind the catalog's rebuild count, the scraper rewrites it, and every cache key
+        includes that file's modification time, so a new catalog invalidates everything at once without the web app
+        talking to the scraper.  Checking the version is a
+        single stat() call, so cached pages are served without touching sqlite.
+"""
+
+import functools
+import hashlib
+import os
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+
+from teas.models import TeaTypes, Tags
+
+
+def catalog_version():
+    """Current catalog version: the modification time of the version file, or "0" before the first scrape."""
+    try:
+        return str(os.stat(settings.CATALOG_VERSION_FILE).st_mtime_ns)
+    except OSError:
+        return "0"
+
+
+def catalog_key(*parts):
+    """Cache key scoped to the current catalog version."""
+    return ":".join(["catalog", catalog_version()] + [str(part) for part in parts])
+
+
+def cached(name, build):
+    """Return the cached value for name, calling build() to create it on a miss."""
+    key = catalog_key(name)
+    value = cache.get(key)
+    if value is None:
+        value = build()
+        cache.set(key, value, settings.CATALOG_CACHE_TIMEOUT)
+    return value
+
+
+def tea_types_menu():
+    """Tea types for the navigation menu and search page."""
+    return cached("tea_types", lambda: list(TeaTypes.objects.order_by("TeaType")))
+
+
+def tags_menu():
+    """Tags for the search page."""
+    return cached("tags", lambda: list(Tags.objects.order_by("TagName")))
+
+
+def cache_catalog_page(view):
+    """
+        View decorator caching the rendered page per URL (path and query string) for the current catalog version.
+        Only successful GET requests are cached.  Pages holding a CSRF token (forms) must not use it.
+        The status and headers (ex. Content-Type and its charset) are cached with the content, so a cached page is
+            served exactly as it was rendered.
+    """
+    @functools.wraps(view)
+    def cached_view(request, *args, **kwargs):
+        if request.method != "GET":
+            return view(request, *args, **kwargs)
+
+        key = catalog_key("page", hashlib.md5(request.get_full_path().encode("utf-8")).hexdigest())
+        page = cache.get(key)
+        if page is None:
+            response = view(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+            cache.set(key, (response.status_code, list(response.items()), response.content),
+                      settings.CATALOG_CACHE_TIMEOUT)
+            return response
+
+        status, headers, content = page
+        response = HttpResponse(content, status=status)
+        for header, value in headers:
+            response[header] = value
+        return response
+    return cached_view
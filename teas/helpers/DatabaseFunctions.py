@@ -0,0 +1,51 @@
+"""
+    DatabaseFunctions.py
+    Purpose: the sqlite connection profile shared by the web app and the scraper, so both open teas.db the same way.
+
+    teas.db is read by the web app while Scraper.py writes to it, so every connection is set up for that:
+        journal_mode=WAL    readers keep reading the last committed catalog while the scraper writes, instead of
+                            failing with "database is locked", and the writer never waits on readers
+        synchronous=NORMAL  commits don't wait on a disk sync (safe with WAL: a power loss can only drop the last
+                            commits, never corrupt the file)
+        mmap_size           pages are read through memory-mapped I/O instead of a read() call each
+        cache_size          larger page cache per connection
+        busy_timeout        a connection that does need the write lock waits for it instead of failing at once
+    The web app applies it to every Django connection (teas.apps, on connection_created) and the scraper to every
+        connection it opens (ScraperDatabase).  This module doesn't use Django so the scraper can import it.
+"""
+
+import sqlite3
+
+JOURNAL_MODE = "WAL"
+SYNCHRONOUS = "NORMAL"
+MMAP_SIZE = 256 * 1024 * 1024   # bytes of the database file mapped into memory
+CACHE_SIZE_KB = 32 * 1024       # page cache per connection
+BUSY_TIMEOUT_MS = 10000         # max time to wait for another connection's write lock
+
+PRAGMAS = [
+    "PRAGMA journal_mode={mode}".format(mode=JOURNAL_MODE),
+    "PRAGMA synchronous={mode}".format(mode=SYNCHRONOUS),
+    "PRAGMA mmap_size={size}".format(size=MMAP_SIZE),
+    # A negative cache_size is in KiB rather than pages.
+    "PRAGMA cache_size=-{size}".format(size=CACHE_SIZE_KB),
+    "PRAGMA busy_timeout={timeout}".format(timeout=BUSY_TIMEOUT_MS)
+    ]
+
+
+def apply_profile(connection):
+    """
+        Set up a new sqlite3 connection with the profile.  Must be called before the connection starts a transaction,
+            since the journal mode can't change inside one.
+    """
+    cursor = connection.cursor()
+    try:
+        for pragma in PRAGMAS:
+            cursor.execute(pragma)
+    finally:
+        cursor.close()
+    return connection
+
+
+def open_connection(path, **kwargs):
+    """sqlite3.connect() with the profile applied.  kwargs are passed to sqlite3.connect()."""
+    return apply_profile(sqlite3.connect(path, **kwargs))
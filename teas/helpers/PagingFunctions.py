@@ -0,0 +1,65 @@
+"""
+    PagingFunctions.py
+    Purpose: keyset (cursor) pagination for the tea lists and search results.
+
+    A page is read with "ORDER BY <sort>, ID ... LIMIT page size", starting after the (sort value, ID) of the last tea
+        on the previous page.  Unlike an OFFSET, sqlite seeks straight to the cursor through the index, so every page
+        costs the same no matter how deep it is or how many teas match.
+"""
+
+import math
+
+from django.db.models import Q
+
+PAGE_SIZE = 50
+CURSOR_SEPARATOR = ":"
+
+
+def encode_cursor(value, id):
+    """Cursor string for the URL.  repr() keeps every digit of a float so the next page starts exactly after it."""
+    return "{value!r}{separator}{id}".format(value=value, separator=CURSOR_SEPARATOR, id=id)
+
+
+def decode_cursor(cursor):
+    """Return (sort value, ID) from a cursor string, or None for the first page or an invalid cursor."""
+    try:
+        value, id = cursor.rsplit(CURSOR_SEPARATOR, 1)
+        value, id = float(value), int(id)
+    except (AttributeError, ValueError):
+        return None
+    # float() also reads "nan" and "inf", which no tea is sorted after.
+    return (value, id) if math.isfinite(value) else None
+
+
+def keyset_page(teas, cursor=None, sort_field="CostOz", page_size=PAGE_SIZE):
+    """
+        Return one page of teas ordered by (sort_field, ID) and the cursor for the next page (None on the last page).
+        sort_field is a model field (ex. CostOz) or an extra select column (ex. the search "rank").
+    """
+    teas = teas.order_by(sort_field, "ID")
+
+    position = decode_cursor(cursor)
+    if position:
+        value, last_id = position
+        if sort_field in teas.query.extra_select:
+            # Extra select columns can't be used in filter(), so compare against their SQL directly.
+            sql, params = teas.query.extra_select[sort_field]
+            teas = teas.extra(
+                where=['({sql}) > %s OR (({sql}) = %s AND "{table}"."ID" > %s)'.format(
+                    sql=sql, table=teas.model._meta.db_table)],
+                params=list(params) + [value] + list(params) + [value, last_id]
+                )
+        else:
+            # Written as a range on sort_field first so sqlite can seek the index to the cursor.
+            teas = teas \
+                .filter(**{sort_field + "__gte": value}) \
+                .filter(Q(**{sort_field + "__gt": value}) | Q(ID__gt=last_id))
+
+    # Read one extra row to know whether there is a next page.
+    page = list(teas[:page_size + 1])
+    next_cursor = None
+    if len(page) > page_size:
+        page = page[:page_size]
+        last = page[-1]
+        next_cursor = encode_cursor(getattr(last, sort_field), last.ID)
+    return page, next_cursor
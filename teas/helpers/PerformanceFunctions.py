@@ -0,0 +1,116 @@
+"""
+    PerformanceFunctions.py
+    Purpose: per-request timings for the web app, recorded by teas.middleware.PerformanceMiddleware.
+
+    Each request gets a RequestTiming (request.timing) holding its SQL query count and time and its template render
+        time.  Views render through render() below so the template time is measured apart from the view's own work.
+    Finished requests are added to per URL name totals (ex. "tealist", "search_results"), which are logged every
+        settings.PERFORMANCE_SUMMARY_EVERY requests so a rise in queries per request (an N+1 query) or in search time
+        shows up in the log.  Totals are kept per server process.
+"""
+
+import threading
+import time
+
+from django import shortcuts
+
+
+class RequestTiming:
+    """Measurements for one request."""
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.total_seconds = 0.0
+        self.sql_queries = 0
+        self.sql_seconds = 0.0
+        self.render_seconds = 0.0
+        self.response_bytes = None
+
+    def execute_wrapper(self, execute, sql, params, many, context):
+        """Database execute wrapper (connection.execute_wrapper) counting and timing every query."""
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_seconds += time.perf_counter() - start
+            self.sql_queries += 1
+
+    def finish(self, response_bytes):
+        self.total_seconds = time.perf_counter() - self.start
+        self.response_bytes = response_bytes
+
+    def server_timing(self):
+        """Value for the Server-Timing response header, shown in the browser's developer tools."""
+        return ", ".join([
+            "view;dur={ms:.1f}".format(ms=self.total_seconds * 1000),
+            'sql;dur={ms:.1f};desc="{queries} queries"'.format(ms=self.sql_seconds * 1000, queries=self.sql_queries),
+            "render;dur={ms:.1f}".format(ms=self.render_seconds * 1000)
+            ])
+
+    def summary(self):
+        return "{total:.1f} ms, {queries} queries in {sql:.1f} ms, render {render:.1f} ms, {size} bytes".format(
+            total=self.total_seconds * 1000, queries=self.sql_queries, sql=self.sql_seconds * 1000,
+            render=self.render_seconds * 1000, size=self.response_bytes)
+
+
+class UrlStats:
+    """Totals for the requests to one URL name."""
+    def __init__(self):
+        self.requests = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.sql_queries = 0
+        self.max_sql_queries = 0
+        self.sql_seconds = 0.0
+        self.render_seconds = 0.0
+        self.response_bytes = 0
+
+    def add(self, timing):
+        self.requests += 1
+        self.total_seconds += timing.total_seconds
+        self.max_seconds = max(self.max_seconds, timing.total_seconds)
+        self.sql_queries += timing.sql_queries
+        self.max_sql_queries = max(self.max_sql_queries, timing.sql_queries)
+        self.sql_seconds += timing.sql_seconds
+        self.render_seconds += timing.render_seconds
+        self.response_bytes += timing.response_bytes or 0
+
+    def report(self):
+        requests = max(self.requests, 1)
+        return {
+            "requests": self.requests,
+            "mean_ms": round(self.total_seconds * 1000 / requests, 1),
+            "max_ms": round(self.max_seconds * 1000, 1),
+            "queries_per_request": round(self.sql_queries / requests, 1),
+            "max_queries": self.max_sql_queries,
+            "sql_ms_per_request": round(self.sql_seconds * 1000 / requests, 1),
+            "render_ms_per_request": round(self.render_seconds * 1000 / requests, 1),
+            "bytes_per_request": round(self.response_bytes / requests)
+            }
+
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def record(url_name, timing):
+    """Add a finished request to the totals for its URL name.  Returns the updated UrlStats report."""
+    with _stats_lock:
+        stats = _stats.setdefault(url_name, UrlStats())
+        stats.add(timing)
+        return stats.report()
+
+
+def url_stats():
+    """Totals so far for every URL name, as {url name: report}."""
+    with _stats_lock:
+        return {url_name: stats.report() for url_name, stats in _stats.items()}
+
+
+def render(request, template_name, context=None):
+    """django.shortcuts.render, timed into the request's RequestTiming when the middleware is installed."""
+    start = time.perf_counter()
+    response = shortcuts.render(request, template_name, context)
+    timing = getattr(request, "timing", None)
+    if timing is not None:
+        timing.render_seconds += time.perf_counter() - start
+    return response
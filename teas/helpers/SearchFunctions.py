@@ -1,6 +1,209 @@
+"""
+    SearchFunctions.py
+    Purpose: parse the TeaFinder search text into a query and apply it to a queryset of teas.
+
+    Supported search syntax:
+        green jasmine       every word must match (each word is a prefix: "jasm" finds "jasmine")
+        "silver needle"     exact phrase
+        -smoky              exclude teas matching a word or phrase
+        pearl OR needle     either word (OR must be upper case)
+        type:oolong         match only the tea type; source:teasource matches only the source name
+        price<5             cost per ounce; also <=, >, >= and =
+    Common words ("the", "with", ...) are ignored unless quoted.  Everything compiles into one SQL query against the
+        TeasSearch full-text index (see migration 0025).
+"""
+
+import re
+
+# Words skipped in free text.  Still searchable inside a quoted phrase.
+STOP_WORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "in", "is", "it", "of", "on", "or", "that", "the",
+    "this", "to", "with"
+    }
+
+# Field prefixes mapped to the TeasSearch columns they search.
+FIELD_COLUMNS = {
+    "type": "TeaType",
+    "source": "SourceName"
+    }
+
+# Price comparisons mapped to Django field lookups on CostOz.
+PRICE_OPERATORS = {
+    "<": "lt",
+    "<=": "lte",
+    ">": "gt",
+    ">=": "gte",
+    "=": "exact"
+    }
+
+OR_KEYWORD = "OR"
+
+TOKEN_PATTERN = re.compile(r"""
+      (?P<price>price\s*(?P<operator><=|>=|<|>|=)\s*\$?(?P<amount>\d+(?:\.\d*)?))
+    | (?P<negate>-)?(?:(?P<field>type|source):)?(?:"(?P<phrase>[^"]*)"?|(?P<word>[^\s"]+))
+    """, re.IGNORECASE | re.VERBOSE)
+
+
+class Term:
+    """A word or quoted phrase to find in the full-text index, optionally limited to one field."""
+    def __init__(self, text, field=None, phrase=False):
+        self.text = text
+        self.field = field
+        self.phrase = phrase
+
+    def __str__(self):
+        return self.to_fts()
+
+    def to_fts(self):
+        """FTS5 syntax for the term.  Quoted so punctuation is searched for literally rather than read as FTS syntax."""
+        fts = '"{text}"'.format(text=self.text.replace('"', '""'))
+        if not self.phrase:
+            fts += "*"
+        if self.field:
+            fts = "{column} : {fts}".format(column=FIELD_COLUMNS[self.field], fts=fts)
+        return fts
+
+
+class AnyOf:
+    """Terms joined by OR."""
+    def __init__(self, terms):
+        self.terms = terms
+
+    def __str__(self):
+        return self.to_fts()
+
+    def to_fts(self):
+        return "(" + " OR ".join(term.to_fts() for term in self.terms) + ")"
+
+
+class PriceFilter:
+    """Cost per ounce comparison, ex. price<5."""
+    def __init__(self, operator, amount):
+        self.operator = operator
+        self.amount = amount
+
+    @property
+    def lookup(self):
+        """Keyword argument for QuerySet.filter(), ex. {"CostOz__lt": 5.0}."""
+        return {"CostOz__" + PRICE_OPERATORS[self.operator]: self.amount}
+
+    def __str__(self):
+        return "price{operator}{amount}".format(operator=self.operator, amount=self.amount)
+
+
+class SearchQuery:
+    """
+        Parsed search text.  Terms (and OR groups) that must match, terms that must not, and price filters.
+        filter() applies the whole query to a queryset as one SQL statement.
+    """
+    def __init__(self, required=None, excluded=None, price_filters=None):
+        self.required = required or []
+        self.excluded = excluded or []
+        self.price_filters = price_filters or []
+
+    def __bool__(self):
+        return bool(self.required or self.excluded or self.price_filters)
+
+    @property
+    def ranked(self):
+        """True if results have a full-text relevance rank to sort by."""
+        return bool(self.required)
+
+    def match_expression(self):
+        """FTS5 MATCH expression for the required and excluded terms.  Empty if there are no required terms."""
+        if not self.required:
+            return ""
+        expression = " AND ".join(clause.to_fts() for clause in self.required)
+        for term in self.excluded:
+            expression += " NOT " + term.to_fts()
+        return expression
+
+    def exclusion_expression(self):
+        """MATCH expression for teas to leave out when there are no required terms (FTS5 NOT needs a left side)."""
+        if self.required or not self.excluded:
+            return ""
+        return " OR ".join(term.to_fts() for term in self.excluded)
+
+    def filter(self, teas):
+        """
+            Apply the query to a queryset of teas.  The model must share its ID with TeasSources (the TeasSearch rowid)
+                and have a CostOz column.  When ranked, a "rank" column holds the bm25 score (lower is a better match).
+        """
+        table = teas.model._meta.db_table
+
+        match = self.match_expression()
+        if match:
+            teas = teas.extra(
+                tables=["TeasSearch"],
+                where=['"TeasSearch".rowid = "{table}"."ID"'.format(table=table), '"TeasSearch" MATCH %s'],
+                params=[match],
+                select={"rank": 'bm25("TeasSearch")'}
+                )
+
+        exclusion = self.exclusion_expression()
+        if exclusion:
+            teas = teas.extra(
+                where=['"{table}"."ID" NOT IN (SELECT rowid FROM "TeasSearch" WHERE "TeasSearch" MATCH %s)'.format(
+                    table=table)],
+                params=[exclusion]
+                )
+
+        for price_filter in self.price_filters:
+            teas = teas.filter(**price_filter.lookup)
+        return teas
+
+
+def tokenize(search_text):
+    """
+        Split search text into tokens.  Yields (kind, value, field, negate) tuples where kind is "word", "phrase",
+            "or" or "price".  Price tokens carry (operator, amount) as their value.
+    """
+    for match in TOKEN_PATTERN.finditer(search_text):
+        if match.group("price"):
+            yield "price", (match.group("operator"), float(match.group("amount"))), None, False
+            continue
+
+        field = match.group("field").lower() if match.group("field") else None
+        negate = bool(match.group("negate"))
+        if match.group("phrase") is not None:
+            yield "phrase", match.group("phrase").strip(), field, negate
+        elif match.group("word") == OR_KEYWORD and not field and not negate:
+            yield "or", OR_KEYWORD, None, False
+        else:
+            yield "word", match.group("word"), field, negate
+
+
 def parse_search_text(search_text):
     """
-        Parses search criteria into individual words.
-        Note this currently only supports single-word criteria separated by spaces.
+        Parse search text into a SearchQuery (see the module notes for the syntax).
+        Words with no letters or digits, and stop words outside of quotes, are dropped.
     """
-    return search_text.split(" ")
\ No newline at end of file
+    query = SearchQuery()
+    join_next = False
+    for kind, value, field, negate in tokenize(search_text):
+        if kind == "price":
+            query.price_filters.append(PriceFilter(*value))
+            continue
+        if kind == "or":
+            # Join the next term to the last required term, if there is one.
+            join_next = bool(query.required)
+            continue
+
+        # Skip empty phrases, punctuation and stop words.
+        if not re.search(r"\w", value, re.UNICODE):
+            continue
+        if kind == "word" and not field and value.lower() in STOP_WORDS:
+            continue
+
+        term = Term(value, field=field, phrase=(kind == "phrase"))
+        if negate:
+            query.excluded.append(term)
+        elif join_next:
+            previous = query.required.pop()
+            terms = previous.terms if isinstance(previous, AnyOf) else [previous]
+            query.required.append(AnyOf(terms + [term]))
+        else:
+            query.required.append(term)
+        join_next = False
+
+    return query
@@ -0,0 +1,47 @@
+"""
+    middleware.py
+    Purpose: request performance instrumentation for the teas app
+
+    PerformanceMiddleware times every request and counts its SQL queries (see helpers/PerformanceFunctions), then:
+        adds a Server-Timing header (view, sql and render durations) when settings.PERFORMANCE_SERVER_TIMING is on
+        adds the request to the totals for its URL name, logged every settings.PERFORMANCE_SUMMARY_EVERY requests
+        logs a warning for requests slower than settings.SLOW_REQUEST_MS
+    It should be first in settings.MIDDLEWARE so the view time includes the other middleware.
+"""
+
+import json
+import logging
+
+from django.conf import settings
+from django.db import connection
+
+import teas.helpers.PerformanceFunctions as Performance
+
+logger = logging.getLogger("teas.performance")
+
+
+class PerformanceMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timing = Performance.RequestTiming()
+        request.timing = timing
+        with connection.execute_wrapper(timing.execute_wrapper):
+            response = self.get_response(request)
+
+        # Streaming responses are sent after the middleware returns, so their size isn't known here.
+        timing.finish(None if response.streaming else len(response.content))
+        if settings.PERFORMANCE_SERVER_TIMING:
+            response["Server-Timing"] = timing.server_timing()
+
+        url_name = request.resolver_match.url_name if request.resolver_match else None
+        url_name = url_name or "unmatched"
+        report = Performance.record(url_name, timing)
+
+        if timing.total_seconds * 1000 >= settings.SLOW_REQUEST_MS:
+            logger.warning("Slow request %s %s (%s): %s", request.method, request.get_full_path(), url_name,
+                           timing.summary())
+        if report["requests"] % settings.PERFORMANCE_SUMMARY_EVERY == 0:
+            logger.info("%s totals: %s", url_name, json.dumps(report, sort_keys=True))
+        return response
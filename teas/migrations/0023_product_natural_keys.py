@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    """
+        Unique natural keys used by the scraper's bulk upsert (ScraperDatabase.bulk_upsert_products).
+        Indexes are created with raw SQL so sqlite adds them in place instead of rebuilding the Teas and TeasSources
+            tables underneath the hand-made TeasSourcesView.
+    """
+
+    dependencies = [
+        ('teas', '0022_teastags'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql='CREATE UNIQUE INDEX "Teas_Name_uniq" ON "Teas" ("Name")',
+            reverse_sql='DROP INDEX "Teas_Name_uniq"',
+            state_operations=[
+                migrations.AlterField(
+                    model_name='teas',
+                    name='Name',
+                    field=models.CharField(max_length=100, unique=True),
+                ),
+            ],
+        ),
+        migrations.RunSQL(
+            sql='CREATE UNIQUE INDEX "TeasSources_SourceID_ProductID_uniq" ON "TeasSources" ("SourceID", "ProductID")',
+            reverse_sql='DROP INDEX "TeasSources_SourceID_ProductID_uniq"',
+            state_operations=[
+                migrations.AlterUniqueTogether(
+                    name='teassources',
+                    unique_together=set([('SourceID', 'ProductID')]),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """
+        Index serving the scraper's set-based deactivation (ScraperDatabase.deactivate_products):
+            UPDATE TeasSources SET IsAvailable = 0 WHERE IsAvailable = 1 AND LastUpdatedDate < ?
+    """
+
+    dependencies = [
+        ('teas', '0023_product_natural_keys'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql='CREATE INDEX "TeasSources_IsAvailable_LastUpdatedDate_idx" ON "TeasSources" ("IsAvailable", "LastUpdatedDate")',
+            reverse_sql='DROP INDEX "TeasSources_IsAvailable_LastUpdatedDate_idx"',
+            state_operations=[
+                migrations.AlterIndexTogether(
+                    name='teassources',
+                    index_together=set([('IsAvailable', 'LastUpdatedDate')]),
+                ),
+            ],
+        ),
+    ]
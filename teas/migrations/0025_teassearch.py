@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+# Columns indexed for each TeasSources row (the FTS rowid is TeasSources.ID).
+SEARCH_ROWS = """
+    SELECT
+        tea_source.ID,
+        tea.Name,
+        tea.Description,
+        tea_type.TeaType,
+        source.SourceName
+    FROM TeasSources tea_source
+    JOIN Teas tea ON tea_source.TeaID = tea.ID
+    JOIN TeaTypes tea_type ON tea.TeaTypeID = tea_type.ID
+    JOIN Sources source ON tea_source.SourceID = source.ID
+"""
+
+INSERT_SEARCH_ROWS = 'INSERT INTO "TeasSearch" (rowid, TeaName, TeaDescription, TeaType, SourceName)' + SEARCH_ROWS
+
+
+class Migration(migrations.Migration):
+    """
+        FTS5 full-text index over tea name, description, type and source, used by views.search.
+        No stemming tokenizer: searches are prefix queries, and stemmed tokens stop matching partly typed words.
+        Kept in sync by triggers so both the scraper and the admin site update it without extra code.
+    """
+
+    dependencies = [
+        ('teas', '0024_teassources_availability_index'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=[
+                """
+                CREATE VIRTUAL TABLE "TeasSearch" USING fts5(
+                    TeaName, TeaDescription, TeaType, SourceName,
+                    tokenize = 'unicode61'
+                )
+                """,
+                INSERT_SEARCH_ROWS,
+                """
+                CREATE TRIGGER "TeasSearch_TeasSources_insert" AFTER INSERT ON "TeasSources"
+                BEGIN
+                    {insert} WHERE tea_source.ID = new.ID;
+                END
+                """.format(insert=INSERT_SEARCH_ROWS),
+                """
+                CREATE TRIGGER "TeasSearch_TeasSources_update" AFTER UPDATE OF TeaID, SourceID ON "TeasSources"
+                BEGIN
+                    DELETE FROM "TeasSearch" WHERE rowid = old.ID;
+                    {insert} WHERE tea_source.ID = new.ID;
+                END
+                """.format(insert=INSERT_SEARCH_ROWS),
+                """
+                CREATE TRIGGER "TeasSearch_TeasSources_delete" AFTER DELETE ON "TeasSources"
+                BEGIN
+                    DELETE FROM "TeasSearch" WHERE rowid = old.ID;
+                END
+                """,
+                """
+                CREATE TRIGGER "TeasSearch_Teas_update" AFTER UPDATE OF Name, Description, TeaTypeID ON "Teas"
+                BEGIN
+                    DELETE FROM "TeasSearch" WHERE rowid IN (SELECT ID FROM TeasSources WHERE TeaID = new.ID);
+                    {insert} WHERE tea.ID = new.ID;
+                END
+                """.format(insert=INSERT_SEARCH_ROWS),
+                """
+                CREATE TRIGGER "TeasSearch_TeaTypes_update" AFTER UPDATE OF TeaType ON "TeaTypes"
+                BEGIN
+                    UPDATE "TeasSearch" SET TeaType = new.TeaType WHERE TeaType = old.TeaType;
+                END
+                """,
+                """
+                CREATE TRIGGER "TeasSearch_Sources_update" AFTER UPDATE OF SourceName ON "Sources"
+                BEGIN
+                    UPDATE "TeasSearch" SET SourceName = new.SourceName WHERE SourceName = old.SourceName;
+                END
+                """,
+                # Without table statistics sqlite drives searches from the IsAvailable index instead of the MATCH.
+                'ANALYZE',
+            ],
+            reverse_sql=[
+                'DROP TRIGGER "TeasSearch_Sources_update"',
+                'DROP TRIGGER "TeasSearch_TeaTypes_update"',
+                'DROP TRIGGER "TeasSearch_Teas_update"',
+                'DROP TRIGGER "TeasSearch_TeasSources_delete"',
+                'DROP TRIGGER "TeasSearch_TeasSources_update"',
+                'DROP TRIGGER "TeasSearch_TeasSources_insert"',
+                'DROP TABLE "TeasSearch"',
+            ],
+        ),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """
+        Index serving the tag filter in views.search, which groups TeasTags rows for the selected tags by tea:
+            SELECT TeaID FROM TeasTags WHERE TagID IN (...) GROUP BY TeaID HAVING COUNT(DISTINCT TagID) = n
+    """
+
+    dependencies = [
+        ('teas', '0025_teassearch'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql='CREATE INDEX "TeasTags_TagID_TeaID_idx" ON "TeasTags" ("TagID", "TeaID")',
+            reverse_sql='DROP INDEX "TeasTags_TagID_TeaID_idx"',
+            state_operations=[
+                migrations.AlterIndexTogether(
+                    name='teastags',
+                    index_together=set([('TagID', 'TeaID')]),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+TEAS_SOURCES_VIEW = """
+    CREATE VIEW "TeasSourcesView"
+    AS
+    SELECT
+        tea_source.ID,
+        tea.ID AS 'TeaID',
+        tea.Name AS 'TeaName',
+        tea.Description AS 'TeaDescription',
+        tea_type.ID AS 'TeaTypeID',
+        tea_type.TeaType,
+        source.SourceName,
+        source.URL AS 'SourceURL',
+        tea_source.URL AS 'ProductURL',
+        tea_source.ImageURL,
+        tea_source.CostOz
+    FROM TeasSources 'tea_source'
+    JOIN Teas 'tea' on tea_source.TeaID = tea.ID
+    JOIN TeaTypes 'tea_type' on tea.TeaTypeID = tea_type.ID
+    JOIN Sources 'source' on tea_source.SourceID = source.ID
+    WHERE tea_source.IsAvailable = 1
+"""
+
+# TeasSearch sync triggers that reference TeasSources (see 0025_teassearch).
+INSERT_SEARCH_ROWS = """
+    INSERT INTO "TeasSearch" (rowid, TeaName, TeaDescription, TeaType, SourceName)
+    SELECT
+        tea_source.ID,
+        tea.Name,
+        tea.Description,
+        tea_type.TeaType,
+        source.SourceName
+    FROM TeasSources tea_source
+    JOIN Teas tea ON tea_source.TeaID = tea.ID
+    JOIN TeaTypes tea_type ON tea.TeaTypeID = tea_type.ID
+    JOIN Sources source ON tea_source.SourceID = source.ID
+"""
+
+SEARCH_TRIGGERS = [
+    """
+    CREATE TRIGGER "TeasSearch_TeasSources_insert" AFTER INSERT ON "TeasSources"
+    BEGIN
+        {insert} WHERE tea_source.ID = new.ID;
+    END
+    """.format(insert=INSERT_SEARCH_ROWS),
+    """
+    CREATE TRIGGER "TeasSearch_TeasSources_update" AFTER UPDATE OF TeaID, SourceID ON "TeasSources"
+    BEGIN
+        DELETE FROM "TeasSearch" WHERE rowid = old.ID;
+        {insert} WHERE tea_source.ID = new.ID;
+    END
+    """.format(insert=INSERT_SEARCH_ROWS),
+    """
+    CREATE TRIGGER "TeasSearch_TeasSources_delete" AFTER DELETE ON "TeasSources"
+    BEGIN
+        DELETE FROM "TeasSearch" WHERE rowid = old.ID;
+    END
+    """,
+    """
+    CREATE TRIGGER "TeasSearch_Teas_update" AFTER UPDATE OF Name, Description, TeaTypeID ON "Teas"
+    BEGIN
+        DELETE FROM "TeasSearch" WHERE rowid IN (SELECT ID FROM TeasSources WHERE TeaID = new.ID);
+        {insert} WHERE tea.ID = new.ID;
+    END
+    """.format(insert=INSERT_SEARCH_ROWS),
+]
+
+
+def rebuild_teas_sources(cost_type, cost_value, indexes):
+    """
+        sqlite can't change a column's type in place, so copy TeasSources into a new table with the new CostOz type.
+        The view and triggers built on TeasSources are dropped first and recreated afterwards, since sqlite refuses to
+            rename a table while a view or trigger refers to a table that is missing.
+    """
+    return [
+        'DROP VIEW IF EXISTS "TeasSourcesView"',
+        'DROP TRIGGER "TeasSearch_Teas_update"',
+        """
+        CREATE TABLE "TeasSources__new" (
+            "ID" integer NOT NULL PRIMARY KEY AUTOINCREMENT,
+            "ProductID" varchar(50) NOT NULL,
+            "CostOz" {cost_type} NOT NULL,
+            "URL" varchar(1000) NOT NULL,
+            "IsAvailable" varchar(1) NOT NULL,
+            "LastUpdatedDate" varchar(25) NOT NULL,
+            "SourceID" integer NOT NULL REFERENCES "Sources" ("ID"),
+            "TeaID" integer NOT NULL REFERENCES "Teas" ("ID"),
+            "ImageURL" varchar(1000) NOT NULL
+        )
+        """.format(cost_type=cost_type),
+        """
+        INSERT INTO "TeasSources__new" (ID, ProductID, CostOz, URL, IsAvailable, LastUpdatedDate, SourceID, TeaID, ImageURL)
+        SELECT ID, ProductID, {cost_value}, URL, IsAvailable, LastUpdatedDate, SourceID, TeaID, ImageURL
+        FROM "TeasSources"
+        """.format(cost_value=cost_value),
+        'DROP TABLE "TeasSources"',
+        'ALTER TABLE "TeasSources__new" RENAME TO "TeasSources"',
+        'CREATE INDEX "TeasSources_87dbaee8" ON "TeasSources" ("SourceID")',
+        'CREATE INDEX "TeasSources_2b4f4ec1" ON "TeasSources" ("TeaID")',
+        'CREATE UNIQUE INDEX "TeasSources_SourceID_ProductID_uniq" ON "TeasSources" ("SourceID", "ProductID")',
+        'CREATE INDEX "TeasSources_IsAvailable_LastUpdatedDate_idx" ON "TeasSources" ("IsAvailable", "LastUpdatedDate")',
+    ] + indexes + SEARCH_TRIGGERS + [TEAS_SOURCES_VIEW, 'ANALYZE']
+
+
+class Migration(migrations.Migration):
+    """
+        Store TeasSources.CostOz as a real number so listings sort on the column itself, walking the new
+            (IsAvailable, CostOz) index, instead of casting text to a number for every row.
+        Existing text costs are converted while the table is copied.
+    """
+
+    dependencies = [
+        ('teas', '0026_teastags_tag_tea_index'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=rebuild_teas_sources(
+                cost_type="real",
+                cost_value='CAST("CostOz" AS REAL)',
+                indexes=['CREATE INDEX "TeasSources_IsAvailable_CostOz_idx" ON "TeasSources" ("IsAvailable", "CostOz")']
+                ),
+            reverse_sql=rebuild_teas_sources(
+                cost_type="varchar(100)",
+                cost_value='CAST("CostOz" AS TEXT)',
+                indexes=[]
+                ),
+            state_operations=[
+                migrations.AlterField(
+                    model_name='teassources',
+                    name='CostOz',
+                    field=models.FloatField(),
+                ),
+                migrations.AlterIndexTogether(
+                    name='teassources',
+                    index_together=set([('IsAvailable', 'LastUpdatedDate'), ('IsAvailable', 'CostOz')]),
+                ),
+                migrations.AlterField(
+                    model_name='teassourcesview',
+                    name='CostOz',
+                    field=models.FloatField(),
+                ),
+            ],
+        ),
+    ]
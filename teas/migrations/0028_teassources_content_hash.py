@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    """
+        Content hash of each scraped product (CommonScraper.Product.fingerprint) so incremental crawls only rewrite
+            products that changed.
+        Added with ALTER TABLE rather than Django's table rebuild, which would drop TeasSourcesView and the TeasSearch
+            triggers built on TeasSources (see 0027_teassources_costoz_real).
+    """
+
+    dependencies = [
+        ('teas', '0027_teassources_costoz_real'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql='ALTER TABLE "TeasSources" ADD COLUMN "ContentHash" varchar(40) NOT NULL DEFAULT \'\'',
+            reverse_sql='ALTER TABLE "TeasSources" DROP COLUMN "ContentHash"',
+            state_operations=[
+                migrations.AddField(
+                    model_name='teassources',
+                    name='ContentHash',
+                    field=models.CharField(default='', max_length=40),
+                ),
+            ],
+        ),
+    ]
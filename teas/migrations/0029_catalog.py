@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Same columns as TeasSourcesView (see 0027_teassources_costoz_real).
+FILL_CATALOG = """
+    INSERT INTO "Catalog" (ID, TeaID, TeaName, TeaDescription, TeaTypeID, TeaType, SourceName, SourceURL, ProductURL,
+        ImageURL, CostOz)
+    SELECT ID, TeaID, TeaName, TeaDescription, TeaTypeID, TeaType, SourceName, SourceURL, ProductURL, ImageURL, CostOz
+    FROM "TeasSourcesView"
+"""
+
+
+class Migration(migrations.Migration):
+    """
+        Catalog: a denormalized table of the available products, so the tea list and search pages read one indexed
+            table instead of evaluating the TeasSourcesView join on every request.
+        Filled from TeasSourcesView here, then rebuilt by the scraper after each run (ScraperDatabase.rebuild_catalog).
+    """
+
+    dependencies = [
+        ('teas', '0028_teassources_content_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Catalog',
+            fields=[
+                ('ID', models.IntegerField(db_column='ID', primary_key=True, serialize=False)),
+                ('TeaID', models.ForeignKey(db_column='TeaID', db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, to='teas.Teas')),
+                ('TeaName', models.CharField(max_length=100)),
+                ('TeaDescription', models.CharField(max_length=1000)),
+                ('TeaTypeID', models.ForeignKey(db_column='TeaTypeID', db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, to='teas.TeaTypes')),
+                ('TeaType', models.CharField(max_length=25)),
+                ('SourceName', models.CharField(max_length=25)),
+                ('SourceURL', models.CharField(max_length=100)),
+                ('ProductURL', models.CharField(max_length=1000)),
+                ('ImageURL', models.CharField(max_length=1000)),
+                ('CostOz', models.FloatField(db_index=True)),
+            ],
+            options={
+                'db_table': 'Catalog',
+                'index_together': set([('TeaType', 'CostOz'), ('SourceName', 'CostOz')]),
+            },
+        ),
+        migrations.RunSQL(
+            sql=[FILL_CATALOG, 'ANALYZE "Catalog"'],
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
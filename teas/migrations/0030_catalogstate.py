@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+# Any write that can change a TeasSourcesView row marks the Catalog table as out of date.
+MARK_DIRTY = 'UPDATE "CatalogState" SET Dirty = 1 WHERE Dirty = 0;'
+
+TRIGGERS = [
+    ('CatalogState_TeasSources_insert', 'AFTER INSERT ON "TeasSources"'),
+    ('CatalogState_TeasSources_update',
+     'AFTER UPDATE OF TeaID, SourceID, CostOz, URL, ImageURL, IsAvailable ON "TeasSources"'),
+    ('CatalogState_TeasSources_delete', 'AFTER DELETE ON "TeasSources"'),
+    ('CatalogState_Teas_update', 'AFTER UPDATE OF Name, Description, TeaTypeID ON "Teas"'),
+    ('CatalogState_TeaTypes_update', 'AFTER UPDATE OF TeaType ON "TeaTypes"'),
+    ('CatalogState_Sources_update', 'AFTER UPDATE OF SourceName, URL ON "Sources"'),
+]
+
+
+class Migration(migrations.Migration):
+    """
+        CatalogState: one row recording whether Catalog is behind TeasSourcesView (Dirty) and a counter of Catalog
+            rebuilds (Version).
+        Triggers set Dirty in the same transaction as the write, whether it comes from a scraper run, ProductDB or the
+            admin site, so a run that dies before rebuilding the catalog leaves it marked for the next run.
+            ScraperDatabase.rebuild_catalog() clears it.  LastUpdatedDate is left out of the trigger columns, since an
+            incremental run bumps it on every product without changing what the catalog shows.
+        Migrations that rebuild TeasSources (as 0027 did) must recreate the triggers.
+    """
+
+    dependencies = [
+        ('teas', '0029_catalog'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=[
+                """
+                CREATE TABLE "CatalogState" (
+                    ID integer NOT NULL PRIMARY KEY CHECK (ID = 1),
+                    Dirty bool NOT NULL,
+                    Version integer NOT NULL
+                )
+                """,
+                # Catalog was just filled from the view by 0029.
+                'INSERT INTO "CatalogState" (ID, Dirty, Version) VALUES (1, 0, 0)',
+            ] + [
+                """
+                CREATE TRIGGER "{name}" {event}
+                BEGIN
+                    {mark_dirty}
+                END
+                """.format(name=name, event=event, mark_dirty=MARK_DIRTY) for name, event in TRIGGERS
+            ],
+            reverse_sql=['DROP TRIGGER "{name}"'.format(name=name) for name, _ in reversed(TRIGGERS)] + [
+                'DROP TABLE "CatalogState"',
+            ],
+        ),
+    ]
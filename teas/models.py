@@ -35,7 +35,7 @@ class Sources(models.Model):
 
 class Teas(models.Model):
     ID = models.AutoField(primary_key=True)
-    Name = models.CharField(max_length=100)
+    Name = models.CharField(max_length=100, unique=True)
     TeaTypeID = models.ForeignKey(TeaTypes, on_delete=models.CASCADE, db_column="TeaTypeID")
     Description = models.CharField(max_length=1000)
     LastUpdatedDate = models.CharField(max_length=25)
@@ -48,17 +48,23 @@ class TeasSources(models.Model):
     TeaID = models.ForeignKey(Teas, on_delete=models.CASCADE, db_column="TeaID")
     SourceID = models.ForeignKey(Sources, on_delete=models.CASCADE, db_column="SourceID")
     ProductID = models.CharField(max_length=50)
-    CostOz = models.CharField(max_length=100)
+    CostOz = models.FloatField()
     URL = models.CharField(max_length=1000)
     ImageURL = models.CharField(max_length=1000)
     IsAvailable = models.CharField(max_length=1)
     LastUpdatedDate = models.CharField(max_length=25)
+    ContentHash = models.CharField(max_length=40, default="")
     class Meta:
         db_table = "TeasSources"
+        unique_together = ("SourceID", "ProductID")
+        index_together = [
+            ("IsAvailable", "LastUpdatedDate"),
+            ("IsAvailable", "CostOz")
+            ]
 
 
-class TeasSourcesView(models.Model):
-    """Model class representing the TeaSourcesView sqlite view"""
+class TeaListing(models.Model):
+    """Columns and display methods of a tea on the tea list pages, shared by TeasSourcesView and Catalog"""
     ID = models.AutoField(primary_key=True, db_column="ID")
     TeaID = models.ForeignKey(Teas, on_delete=models.DO_NOTHING, db_column="TeaID")
     TeaName = models.CharField(max_length=100)
@@ -69,10 +75,9 @@ class TeasSourcesView(models.Model):
     SourceURL = models.CharField(max_length=100)
     ProductURL = models.CharField(max_length=1000)
     ImageURL = models.CharField(max_length=1000)
-    CostOz = models.CharField(max_length=100)
+    CostOz = models.FloatField()
     class Meta:
-        managed = False
-        db_table = "TeasSourcesView"
+        abstract = True
 
     def __str__(self):
         return ', '.join([
@@ -84,10 +89,34 @@ class TeasSourcesView(models.Model):
         return "\u00A9 " + self.SourceName
     
     def display_cost(self):
-        return "{0:.2f}".format(float(self.CostOz))
+        return "{0:.2f}".format(self.CostOz)
         
     def convert_cost_oz_to_float(self):
-        return float(self.CostOz)
+        return self.CostOz
+
+
+class TeasSourcesView(TeaListing):
+    """Model class representing the TeaSourcesView sqlite view"""
+    class Meta:
+        managed = False
+        db_table = "TeasSourcesView"
+
+
+class Catalog(TeaListing):
+    """
+        Denormalized copy of TeasSourcesView (available products only) read by the tea list and search pages.
+        ID is the TeasSources ID (the TeasSearch rowid).  Rebuilt by ScraperDatabase.rebuild_catalog() after each scrape.
+    """
+    ID = models.IntegerField(primary_key=True, db_column="ID")
+    TeaID = models.ForeignKey(Teas, on_delete=models.DO_NOTHING, db_column="TeaID", db_constraint=False)
+    TeaTypeID = models.ForeignKey(TeaTypes, on_delete=models.DO_NOTHING, db_column="TeaTypeID", db_constraint=False)
+    CostOz = models.FloatField(db_index=True)
+    class Meta:
+        db_table = "Catalog"
+        index_together = [
+            ("TeaType", "CostOz"),
+            ("SourceName", "CostOz")
+            ]
 
 
 class Tags(models.Model):
@@ -103,3 +132,4 @@ class TeasTags(models.Model):
     TagID = models.ForeignKey(Tags, on_delete=models.CASCADE, db_column="TagID")
     class Meta:
         db_table = "TeasTags"
+        index_together = ("TagID", "TeaID")
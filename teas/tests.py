@@ -1,3 +1,254 @@
-from django.test import TestCase
+import os
+import shutil
+import sqlite3
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+
+import ScraperDatabase
+from ScraperTemplates.CommonScraper import Product
+from teas.models import Catalog, TeaTypes
+import teas.helpers.PagingFunctions as Paging
+import teas.helpers.SearchFunctions as Search
+
+
+class SearchTextTests(SimpleTestCase):
+    """Search syntax parsing (helpers/SearchFunctions).  Pure parsing, so no database is needed."""
+
+    def test_words_are_prefix_terms(self):
+        query = Search.parse_search_text("green jasmine")
+        self.assertEqual(query.match_expression(), '"green"* AND "jasmine"*')
+        self.assertTrue(query.ranked)
+
+    def test_quoted_phrase(self):
+        query = Search.parse_search_text('"silver needle" white')
+        self.assertEqual(query.match_expression(), '"silver needle" AND "white"*')
+
+    def test_unclosed_quote_runs_to_the_end(self):
+        query = Search.parse_search_text('"silver needle')
+        self.assertEqual(query.match_expression(), '"silver needle"')
+
+    def test_or_group(self):
+        query = Search.parse_search_text("pearl OR needle OR jade green")
+        self.assertEqual(len(query.required), 2)
+        self.assertIsInstance(query.required[0], Search.AnyOf)
+        self.assertEqual(query.match_expression(), '("pearl"* OR "needle"* OR "jade"*) AND "green"*')
+
+    def test_lower_case_or_is_a_stop_word(self):
+        query = Search.parse_search_text("pearl or needle")
+        self.assertEqual(query.match_expression(), '"pearl"* AND "needle"*')
+
+    def test_dangling_or_is_ignored(self):
+        self.assertEqual(Search.parse_search_text("OR green").match_expression(), '"green"*')
+        self.assertEqual(Search.parse_search_text("green OR").match_expression(), '"green"*')
+
+    def test_price_filters(self):
+        query = Search.parse_search_text("price<=5 price > $2.50")
+        self.assertEqual([price_filter.lookup for price_filter in query.price_filters],
+                         [{"CostOz__lte": 5.0}, {"CostOz__gt": 2.5}])
+        self.assertEqual(query.match_expression(), "")
+        self.assertFalse(query.ranked)
+
+    def test_price_without_amount_is_searched_as_text(self):
+        query = Search.parse_search_text("price<")
+        self.assertEqual(query.price_filters, [])
+        self.assertEqual(query.match_expression(), '"price<"*')
+
+    def test_field_and_exclusion(self):
+        query = Search.parse_search_text("type:oolong -smoky")
+        self.assertEqual(query.match_expression(), 'TeaType : "oolong"* NOT "smoky"*')
+
+    def test_exclusion_only(self):
+        query = Search.parse_search_text('-"earl grey"')
+        self.assertEqual(query.match_expression(), "")
+        self.assertEqual(query.exclusion_expression(), '"earl grey"')
+
+    def test_stop_words_are_dropped_unless_quoted(self):
+        self.assertEqual(Search.parse_search_text("the tea with milk").match_expression(), '"tea"* AND "milk"*')
+        self.assertEqual(Search.parse_search_text('"the tea"').match_expression(), '"the tea"')
+
+    def test_empty_and_punctuation_only_input(self):
+        for search_text in ["", "   ", '!!! "" - ?', "OR"]:
+            with self.subTest(search_text=search_text):
+                self.assertFalse(Search.parse_search_text(search_text))
+
+    def test_quotes_inside_terms_are_escaped(self):
+        self.assertEqual(Search.Term('say "hi"', phrase=True).to_fts(), '"say ""hi"""')
+
+    def test_tokenize(self):
+        self.assertEqual(list(Search.tokenize('-source:teasource "green tea" OR price>=3')), [
+            ("word", "teasource", "source", True),
+            ("phrase", "green tea", None, False),
+            ("or", "OR", None, False),
+            ("price", (">=", 3.0), None, False)
+            ])
+
+
+class CursorTests(SimpleTestCase):
+    """Cursor strings (helpers/PagingFunctions) as they travel in the URL."""
+
+    def test_round_trip_keeps_every_digit(self):
+        self.assertEqual(Paging.decode_cursor(Paging.encode_cursor(0.1 + 0.2, 7)), (0.1 + 0.2, 7))
+
+    def test_tampered_cursor_is_ignored(self):
+        for cursor in [None, "", "abc", "1.5", "1.5:", "1.5:x", "x:3", "nan:3", "inf:3", "-inf:3"]:
+            with self.subTest(cursor=cursor):
+                self.assertIsNone(Paging.decode_cursor(cursor))
+
+
+class KeysetPageTests(TestCase):
+    """Paging through Catalog (helpers/PagingFunctions) and the Next/First links on the tea list and search pages."""
+
+    TEA_COUNT = Paging.PAGE_SIZE + 10
+    COSTS = [1.0, 2.5, 2.5, 4.0]
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.tea_type = TeaTypes.objects.create(TeaType="Test Tea")
+        # Several teas per cost, with IDs out of cost order, so pages have to break ties on ID.
+        Catalog.objects.bulk_create([
+            Catalog(ID=id, TeaID_id=id, TeaName="Tea {id}".format(id=id), TeaDescription="", TeaTypeID=cls.tea_type,
+                    TeaType="Test Tea", SourceName="Test Source", SourceURL="", ProductURL="", ImageURL="",
+                    CostOz=cls.COSTS[id * 7 % len(cls.COSTS)])
+            for id in range(1, cls.TEA_COUNT + 1)
+            ])
+
+    def setUp(self):
+        cache.clear()
+
+    def teas(self):
+        return Catalog.objects.filter(TeaTypeID=self.tea_type)
+
+    def read_all_pages(self, teas, page_size, sort_field="CostOz"):
+        """IDs of every tea, following the cursors from the first page to the last."""
+        ids = []
+        cursor = None
+        # A cursor that doesn't move forward would page forever, so stop after more pages than there can be.
+        for _ in range(self.TEA_COUNT + 1):
+            page, cursor = Paging.keyset_page(teas, cursor=cursor, sort_field=sort_field, page_size=page_size)
+            ids.extend(tea.ID for tea in page)
+            if not cursor:
+                return ids
+        self.fail("Paging didn't reach the last page")
+
+    def test_pages_have_no_gaps_or_duplicates(self):
+        expected = list(self.teas().order_by("CostOz", "ID").values_list("ID", flat=True))
+        for page_size in [1, 3, 7, self.TEA_COUNT, self.TEA_COUNT + 1]:
+            with self.subTest(page_size=page_size):
+                self.assertEqual(self.read_all_pages(self.teas(), page_size), expected)
+
+    def test_extra_select_sort_field(self):
+        teas = self.teas().extra(select={"rank": '-"Catalog"."CostOz"'})
+        expected = [tea.ID for tea in sorted(self.teas(), key=lambda tea: (-tea.CostOz, tea.ID))]
+        self.assertEqual(self.read_all_pages(teas, 7, sort_field="rank"), expected)
+
+    def test_tampered_cursor_reads_the_first_page(self):
+        first_page, _ = Paging.keyset_page(self.teas(), page_size=5)
+        for cursor in ["abc", "nan:3", "1.5:x"]:
+            with self.subTest(cursor=cursor):
+                page, _ = Paging.keyset_page(self.teas(), cursor=cursor, page_size=5)
+                self.assertEqual(page, first_page)
+
+    def test_tea_list_with_tampered_cursor(self):
+        response = self.client.get("/tealist/Test%20Tea", {"cursor": "nan:3"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["tea_list"], list(self.teas().order_by("CostOz", "ID")[:Paging.PAGE_SIZE]))
+
+    def test_search_links_keep_the_criteria(self):
+        criteria = "tea_types={id}".format(id=self.tea_type.ID)
+        response = self.client.get("/search/results?" + criteria)
+        self.assertIsNone(response.context["first_page"])
+        next_page = response.context["next_page"]
+        self.assertTrue(next_page.startswith("?" + criteria + "&cursor="))
+        ids = [tea.ID for tea in response.context["tea_list"]]
+
+        response = self.client.get("/search/results" + next_page)
+        self.assertEqual(response.context["first_page"], "/search/results?" + criteria)
+        self.assertIsNone(response.context["next_page"])
+        ids.extend(tea.ID for tea in response.context["tea_list"])
+        self.assertEqual(ids, list(self.teas().order_by("CostOz", "ID").values_list("ID", flat=True)))
+
+
+class ScraperDatabaseTests(TestCase):
+    """
+        ScraperDatabase writes against a temporary copy of the migrated test database, since the scraper opens its own
+            sqlite connections (by ScraperDatabase.DB_PATH) rather than Django's.
+    """
+
+    SOURCE = "Test Source"
+    TEA_TYPE = "Test Tea"
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.db_path = os.path.join(directory, "teas.db")
+
+        connection.ensure_connection()
+        copy = sqlite3.connect(self.db_path)
+        connection.connection.backup(copy)
+        copy.execute("INSERT INTO TeaTypes (TeaType) VALUES (?)", (self.TEA_TYPE,))
+        copy.execute("INSERT INTO Sources (SourceName, URL) VALUES (?, ?)", (self.SOURCE, "http://example.com"))
+        copy.commit()
+        copy.close()
+
+        patcher = mock.patch.object(ScraperDatabase, "DB_PATH", self.db_path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def product(self, id, cost=2.0, source=SOURCE):
+        return Product(name="Tea " + id, description="A test tea", cost=cost, source=source, id=id,
+                       url="http://example.com/" + id, type=self.TEA_TYPE)
+
+    def query(self, sql, parameters=()):
+        """Run sql on the temporary database, outside of ScraperDatabase.  Returns the rows."""
+        db = sqlite3.connect(self.db_path)
+        try:
+            rows = db.execute(sql, parameters).fetchall()
+            db.commit()
+            return rows
+        finally:
+            db.close()
+
+    def test_incremental_upsert_only_rewrites_changed_products(self):
+        products = [self.product("a"), self.product("b")]
+        result = ScraperDatabase.bulk_upsert_products(products, update_date="2020-01-01 00:00:00", incremental=True)
+        self.assertEqual((result.saved, result.changed), (2, 2))
+
+        # Only b's content changes.  a is still marked as seen.
+        products = [self.product("a"), self.product("b", cost=3.0)]
+        result = ScraperDatabase.bulk_upsert_products(products, update_date="2020-01-02 00:00:00", incremental=True)
+        self.assertEqual((result.saved, result.changed), (2, 1))
+        self.assertEqual(result.urls, ["http://example.com/a", "http://example.com/b"])
+        self.assertEqual(
+            self.query("SELECT ProductID, CostOz, LastUpdatedDate, ContentHash FROM TeasSources ORDER BY ProductID"),
+            [("a", 2.0, "2020-01-02 00:00:00", products[0].fingerprint()),
+             ("b", 3.0, "2020-01-02 00:00:00", products[1].fingerprint())])
+
+    def test_upsert_skips_unknown_sources(self):
+        result = ScraperDatabase.bulk_upsert_products([self.product("a"), self.product("b", source="Unknown")])
+        self.assertEqual((result.saved, result.changed, result.urls), (1, 1, ["http://example.com/a"]))
+
+    def test_rebuild_catalog_swaps_in_the_available_products(self):
+        indexes_sql = "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'Catalog' ORDER BY name"
+        indexes = self.query(indexes_sql)
+        version = ScraperDatabase.catalog_state()["Version"]
+
+        ScraperDatabase.bulk_upsert_products([self.product("a", cost=3.0), self.product("b", cost=1.0)])
+        self.assertTrue(ScraperDatabase.catalog_dirty())
+        self.assertEqual(ScraperDatabase.rebuild_catalog(), 2)
+        self.assertEqual(self.query("SELECT TeaName, CostOz FROM Catalog ORDER BY CostOz"),
+                         [("Tea b", 1.0), ("Tea a", 3.0)])
+        self.assertEqual(self.query(indexes_sql), indexes)
+        self.assertEqual(self.query("SELECT name FROM sqlite_master WHERE name = ?",
+                                    (ScraperDatabase.CATALOG_SHADOW_TABLE,)), [])
+        self.assertFalse(ScraperDatabase.catalog_dirty())
+        self.assertEqual(ScraperDatabase.catalog_state()["Version"], version + 1)
+
+        # Products no longer available leave the catalog on the next rebuild.
+        self.query("UPDATE TeasSources SET IsAvailable = 0 WHERE ProductID = 'a'")
+        self.assertTrue(ScraperDatabase.catalog_dirty())
+        self.assertEqual(ScraperDatabase.rebuild_catalog(), 1)
+        self.assertEqual(self.query("SELECT TeaName FROM Catalog"), [("Tea b",)])
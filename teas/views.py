@@ -6,125 +6,147 @@
     Created Date: 12/8/2016
 """
 
-from django.shortcuts import render, get_object_or_404
-from django.http import HttpResponse
-from django.db.models import FloatField, ExpressionWrapper, F, Q
+from django.shortcuts import get_object_or_404
+from django.http import HttpResponse, QueryDict
+from django.db.models import Count, Q
 from functools import reduce
 import operator
 
-from teas.models import TeasSourcesView, TeaTypes, Tags, TeasTags
+from teas.models import Catalog, TeasTags
 import teas.helpers.SearchFunctions as Search
+import teas.helpers.PagingFunctions as Paging
+import teas.helpers.CacheFunctions as Cache
+from teas.helpers.PerformanceFunctions import render
 
 
+@Cache.cache_catalog_page
 def index(request):
     """Render homepage"""
     context = {
-        "tea_types": TeaTypes.objects.order_by("TeaType")
+        "tea_types": Cache.tea_types_menu()
     }
     return render(request, "teas/index.html", context)
 
 
 def search_render_page(request):
-    """Render basic search page"""
+    """Render basic search page.  Not cached as a page since the form holds a CSRF token."""
     context = {
-        "tea_types": TeaTypes.objects.order_by("TeaType"),
-        "tags": Tags.objects.order_by("TagName")
+        "tea_types": Cache.tea_types_menu(),
+        "tags": Cache.tags_menu()
     }
     return render(request, "teas/search.html", context)
 
 
+def integer_values(values):
+    """IDs from a multi-value form field.  Values that aren't integers (ex. a hand-edited URL) are ignored."""
+    return [int(value) for value in values if value.isdecimal()]
+
+
 def search(request):
     """Perform search and render search results"""
     
-    # Get search criteria from the posted values on the serach page
-    search_text = request.POST["search_text"]
-    tea_types = request.POST.getlist("tea_types")
-    tags = request.POST.getlist("tags[]")
+    # Get search criteria from the values submitted on the serach page.  Later pages of results are requested with GET.
+    form = request.POST if request.method == "POST" else request.GET
+    search_text = form.get("search_text", "")
+    tea_types = integer_values(form.getlist("tea_types"))
+    tags = integer_values(form.getlist("tags[]"))
     
-    # Parse the search text into its respective keywords.  
-    search_text = Search.parse_search_text(search_text)
+    # Parse the search text into a query (see SearchFunctions for the supported syntax).
+    query = Search.parse_search_text(search_text)
     
     # Get teas that match all criteria
-    teas = TeasSourcesView.objects.all()
+    teas = Catalog.objects.all()
     
     # SEARCH STRING
-    if len(search_text) > 0:
-        teas = teas.filter(
-            # http://stackoverflow.com/questions/4824759/django-query-using-contains-each-value-in-a-list
-            reduce(operator.and_, (Q(TeaDescription__icontains=criteria) for criteria in search_text))
-            )
+    # Words, phrases and field filters are matched against the TeasSearch full-text index in the same SQL query.
+    teas = query.filter(teas)
     
     # TEA TYPES
     if len(tea_types) > 0:
         teas = teas.filter(
             # http://stackoverflow.com/questions/4824759/django-query-using-contains-each-value-in-a-list
-            reduce(operator.or_, (Q(TeaTypeID__exact=int(criteria)) for criteria in tea_types))
+            reduce(operator.or_, (Q(TeaTypeID__exact=criteria) for criteria in tea_types))
             )
     
     # FILTER BY TAGS
+    # Keep teas carrying every selected tag.  The intersection is a grouped subquery on TeasTags (served by the
+    # (TagID, TeaID) index), so it runs inside the same SQL query as the rest of the search.
     if len(tags) > 0:
-        
-        # Collect all teas that contain all of the selected tags:
-        tea_id = {tea.TeaID for tea in TeasTags.objects.all()}
-        for tag in tags:
-            tea_id = {tea.TeaID for tea in TeasTags.objects.filter(TagID=int(tag)) if tea.TeaID in tea_id}
-        
-        # Then filter the tea set to the ones contained in the above results.  If no teas found with the list of tags, return 
-        # no results
-        if len(tea_id) == 0:
-            teas = []
-        else: 
-            teas = teas.filter(
-                    # http://stackoverflow.com/questions/4824759/django-query-using-contains-each-value-in-a-list
-                    reduce(operator.or_, (Q(TeaID__exact=tea.ID) for tea in tea_id))
-                    )
-        
-        # Sort the final results:
-        if teas:
-            teas = teas.annotate(ordering=ExpressionWrapper(F("CostOz") + 0, output_field=FloatField())).order_by("ordering", "TeaType")
+        tag_ids = set(tags)
+        tagged_teas = TeasTags.objects \
+                    .filter(TagID__in=tag_ids) \
+                    .values("TeaID") \
+                    .annotate(tag_count=Count("TagID", distinct=True)) \
+                    .filter(tag_count=len(tag_ids)) \
+                    .values("TeaID")
+        teas = teas.filter(TeaID__in=tagged_teas)
     
-    # Render the search results
-    return tea_list(request, teas_query_set=teas)
+    # Render the search results: best text matches first when searching by text, otherwise by cost.
+    return render_tea_list(request, teas, sort_field="rank" if query.ranked else "CostOz", form=form)
 
 
-def tea_list(request, tea_type="", teas_query_set=None):
-    """Render list of teas from tea types, all teas, or serach results"""
+@Cache.cache_catalog_page
+def tea_list(request, tea_type=""):
+    """
+        Render list of teas from tea types, or all teas.
+        Pages are cached until the next scraper run (see CacheFunctions).
+    """
     
-    # Begin with an empty header to update later
-    header = ""
+    # If tea type was passed in, filter teas by tea type and set the header accordingly
+    if len(tea_type) > 0:
+        teas_query_set = Catalog.objects.filter(TeaType=tea_type)
+                    
+        # Pluralize for display purposes:
+        header = tea_type + 's'
     
-    # If no teas are passed into the function (typically from a web search)
-    if teas_query_set is None:
-        # If tea type was passed in, filter teas by tea type and set the header accordingly
-        if len(tea_type) > 0:
-            teas_query_set = TeasSourcesView.objects \
-                        .filter(TeaType=tea_type) \
-                        .annotate(ordering=ExpressionWrapper(F("CostOz") + 0, output_field=FloatField())) \
-                        .order_by("ordering", "TeaType")
-                        
-            # Pluralize for display purposes:
-            header = tea_type + 's'
-        
-        else:
-            # If tea type is also not specified, return all teas.
-            teas_query_set = TeasSourcesView.objects \
-                        .annotate(ordering=ExpressionWrapper(F("CostOz") + 0, output_field=FloatField())) \
-                        .order_by("ordering", "TeaType")
-                        
-            # Display header for HTML
-            header = "Tea List"
-            
-    # If a query set of teas passed in, display those teas.
     else:
-        if len(teas_query_set) == 0:
+        # If tea type is also not specified, return all teas.
+        teas_query_set = Catalog.objects.all()
+                    
+        # Display header for HTML
+        header = "Tea List"
+    
+    return render_tea_list(request, teas_query_set, header=header)
+
+
+def render_tea_list(request, teas_query_set, header="", sort_field="CostOz", form=None):
+    """
+        Render list of teas from tea types, all teas, or serach results.
+        Teas are shown one page at a time (see PagingFunctions).  The "cursor" URL parameter selects the page.
+    """
+    
+    # Count the matches in the database rather than loading them all.
+    tea_count = teas_query_set.count()
+    
+    # If a query set of teas passed in, display those teas.
+    if not header:
+        if tea_count == 0:
             header = "No matches found"
         else:
             header = "Search Results"
-
+    
+    # Read only the requested page, and build the link to the next page with the same search criteria.
+    cursor = request.GET.get("cursor")
+    teas, next_cursor = Paging.keyset_page(teas_query_set, cursor=cursor, sort_field=sort_field)
+    # The first page link keeps the search criteria too, dropping only the cursor.
+    parameters = form.copy() if form is not None else QueryDict(mutable=True)
+    parameters.pop("csrfmiddlewaretoken", None)
+    parameters.pop("cursor", None)
+    first_page = None
+    if cursor:
+        first_page = request.path + ("?" + parameters.urlencode() if parameters else "")
+    next_page = None
+    if next_cursor:
+        parameters["cursor"] = next_cursor
+        next_page = "?" + parameters.urlencode()
+    
     # Render the tea list page
     context = {
-        "tea_list": teas_query_set,
-        "tea_types": TeaTypes.objects.all().order_by("TeaType"),
+        "tea_list": teas,
+        "tea_count": tea_count,
+        "next_page": next_page,
+        "first_page": first_page,
+        "tea_types": Cache.tea_types_menu(),
         "tea_type_filter": header
     }
     return render(request, "teas/tealist.html", context)